@@ -9,9 +9,50 @@
 #               present, also queues a publish to update a timestamp for
 #               the cid, in any repository.
 #     publish : Queues tarball in POSTed body for publication in cid
-#               xxxxx.  If already present, returns PRESENT:path and
-#               publishes a timestamp like "update", otherwise returns OK
-#               and publishing is queued to happen as soon as possible.
+#               xxxxx.  The tarball may be compressed with gzip, zstd, xz
+#               or bzip2, and the optional format=<compression> (or
+#               format=tar) parameter tells which.  If already present,
+#               returns PRESENT:path and publishes a timestamp like
+#               "update", otherwise returns OK and publishing is queued
+#               to happen as soon as possible.
+#               If the cid is already present or already being published
+#               the response is sent without reading the body, so
+#               clients sending "Expect: 100-continue" do not upload it.
+#     uploadinit : Starts a session for uploading the tarball for cid
+#               xxxxx in chunks, for big tarballs over unreliable
+#               networks.  Requires the size=<bytes> parameter and takes
+#               the same optional format parameter as "publish".  Returns
+#               SESSION:id, or PRESENT:path or OK like "publish" if there
+#               is no need to upload.  Sessions count toward the same
+#               per-publisher limits as uploads in progress.
+#     uploadchunk : Writes the POSTed or PUT body into the session given
+#               by session=id at the byte offset=<bytes> parameter.
+#               Chunks may be sent in any order and in parallel, and
+#               resent after errors.  Returns OK.
+#     uploadstatus : Returns SIZE:bytes and RECEIVED:ranges lines for
+#               the session given by session=id, where ranges is a
+#               comma-separated list of start-end byte ranges that have
+#               arrived (end not included).
+#     uploadcommit : Queues the tarball of the session given by
+#               session=id for publication once all of it has arrived,
+#               responding like "publish".  Sessions not used for
+#               sessionexpirehours are removed by the daily cleanup.
+#     bulkexists : Like "exists" for a list of cids POSTed in the body,
+#               one per line, instead of the cid parameter.  Returns one
+#               line of PRESENT:path or MISSING for each cid, in the
+#               same order.
+#     bulkupdate : Like "update" for a list of cids POSTed in the body,
+#               with a response like "bulkexists".
+#     wait :    Waits until cid xxxxx has been published and is visible
+#               in the /cvmfs2 replica on this server, then returns
+#               PRESENT:path like "exists".  Returns FAILED if the
+#               publish failed, MISSING if the cid is neither present
+#               nor being published, and PUBLISHING if it is still
+#               being published after the optional timeout=seconds
+#               parameter (default 60, at most maxwaittimeout).
+#               Without the asynchronous front end it returns
+#               PUBLISHING right away when maxblockingwaiters requests
+#               are already waiting.
 # All of the above are on https and require a user certificate.
 #               
 # cid is the Code IDentifier, expected to be a secure hash of the
@@ -24,6 +65,11 @@
 #     config :  Returns configuration, currently the label "repos:"
 #               followed by a comma-separated list of repositories
 #     ping :   Returns OK in the body
+#     metrics : Returns counters and histograms about requests, the
+#               publish queue, publishing and garbage collection in the
+#               Prometheus text exposition format.  With publisherd, the
+#               ones from the daemon follow with a cvmfs_user_pubd_
+#               prefix.
 #
 # This source file is Copyright (c) 2019, FERMI NATIONAL ACCELERATOR
 #    LABORATORY.  All rights reserved.
@@ -32,7 +78,7 @@
 from __future__ import print_function
 
 import os, threading, time, datetime
-import socket, subprocess, select
+import socket, subprocess, select, signal
 import fcntl
 try:
     from urllib.parse import parse_qs
@@ -42,34 +88,129 @@ except:  # python < 3
     from urlparse import parse_qs
     from urllib import unquote
     import Queue as queue
-import shutil, re
+import shutil, re, hashlib, json, uuid, base64, collections
+import zlib, bz2
 import scitokens
+try:
+    from scitokens.utils.keycache import KeyCache
+except ImportError:
+    KeyCache = None
+try:
+    import lzma
+except ImportError:  # python < 3
+    lzma = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
-confcachetime = 300  # 5 minutes
+confcheckinterval = 10
 userpubconffile = '/etc/cvmfs-user-pub.conf'
 alloweddnsfile = '/etc/grid-security/grid-mapfile'
 queuedir = '/tmp/cvmfs-user-pub'
 prefix = 'sw'
 gcstarthour = 3
 maxdays = 30
+batchmaxcids = 1
+batchmaxmb = 0
+batchwait = 0
+timestampwait = 0
+timestampmaxcids = 0
+gcbatchsize = 1000
+gcthreads = 4
+schedpolicy = 'fifo'
+smalljobmb = 100
+maxqueuewait = 600 # 10 minutes
+fairshare = False
+placement = 'any'
+placementstrict = False
+maxpublisheruploads = 0
+maxpublishermb = 0
+maxpublisherperhour = 0
+indexinterval = 60
+maxwaittimeout = 300 # 5 minutes
+maxblockingwaiters = 2
+missingcachetime = 10
+missingcachesize = 100000
+snapshotrequestfile = '/var/lib/cvmfs-user-pub/snapshotrequests'
+streamuploads = False
+dedupuploads = False
+verifycidhash = False
+validateuploads = False
+sessiondir = ''
+sessionexpirehours = 24
+hashindexfile = '/var/lib/cvmfs-user-pub/hashindex'
+tracefile = ''
+publisherd = False
+journalfile = '/var/lib/cvmfs-user-pub/journal'
+publishersocket = '/run/cvmfs-user-pub/publisherd.sock'
+publishermetricsfile = '/run/cvmfs-user-pub/publisherd.metrics'
+runningpublisherd = False
+stoppingpublisherd = False
+servicestatefile = '/run/cvmfs-user-pub.running'
+tokencachesize = 1000
+issuerkeyrefresh = 1800 # 30 minutes
 alloweddns = set()
 issuers = set()
 audiences = set()
+acceptedaudiences = []
 
 userpubconf = {}
-confupdatetime = 0
+confsnapshot = None
 userpubconfmodtime = 0
 alloweddnsmodtime = 0
 issuersmodtime = 0
+maxbulkbytes = 1048576 # 1MB of cids in a bulk request
 servicecachetime = 5 # 5 seconds
 servicestatustime = 0
 servicerunning = False
 conflock = threading.Lock()
-pubqueue = queue.Queue()
 tslock = threading.Lock()
 tscids = {}
 publock = threading.Lock()
 pubcids = {}
+publisheruploads = {}
+publisherbytes = {}
+publishertimes = {}
+repolocks = {}
+indexlock = threading.Lock()
+cidindex = {}
+repocidcounts = {}
+recentcids = {}
+recentcidtime = 3600 # 1 hour
+staletmptime = 3600 # 1 hour
+missingcids = collections.OrderedDict()
+indexwakeup = threading.Event()
+waitlock = threading.Lock()
+waiters = {}
+blockingwaiters = 0
+tokenlock = threading.Lock()
+tokencache = collections.OrderedDict()
+tokengeneration = 0
+issuerkids = set()
+hashlock = threading.Lock()
+hashesloaded = False
+hashcids = {}
+cidhashes = {}
+metricslock = threading.Lock()
+metrictypes = {}
+counters = {}
+histograms = {}
+queuedtimes = {}
+tarstats = {}
+tracequeue = queue.Queue(10000)
+traceids = {}
+secondsbuckets = [0.1, 0.5, 1, 2, 5, 10, 30, 60, 120, 300, 600, 1800, 3600]
+countbuckets = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000]
+ratebuckets = [1e5, 1e6, 1e7, 3e7, 1e8, 3e8, 1e9]
+filebuckets = [10, 100, 1000, 10000, 100000, 1000000]
+bytebuckets = [1e6, 1e7, 1e8, 1e9, 1e10, 1e11]
+compressionmagic = [(b'\x1f\x8b', 'gzip'), (b'\x28\xb5\x2f\xfd', 'zstd'),
+                    (b'\xfd7zXZ\x00', 'xz'), (b'BZh', 'bzip2')]
+tarformats = ['tar', 'gzip', 'zstd', 'xz', 'bzip2']
+metricapis = ['exists', 'update', 'bulkexists', 'bulkupdate', 'publish',
+              'uploadinit', 'uploadchunk', 'uploadstatus', 'uploadcommit',
+              'wait', 'config', 'ping', 'metrics', 'startup', 'shutdown']
 
 def logmsg(ip, id, msg):
     print( '(' + ip + ' ' + id + ') '+ msg )
@@ -84,6 +225,15 @@ def error_request(start_response, response_code, response_body):
                     ('Content-Length', str(len(response_body)))])
     return [response_body.encode('utf-8')]
 
+def busy_request(start_response, ip, id, reason, retryafter):
+    response_body = 'Too many requests: ' + reason + '\n'
+    logmsg(ip, id, 'too many requests: ' + reason)
+    start_response('429 Too many requests',
+                   [('Cache-control', 'max-age=0'),
+                    ('Retry-After', str(int(retryafter))),
+                    ('Content-Length', str(len(response_body)))])
+    return [response_body.encode('utf-8')]
+
 def bad_request(start_response, ip, id, reason):
     response_body = 'Bad request: ' + reason
     logmsg(ip, id, 'bad request: ' + reason)
@@ -97,6 +247,142 @@ def good_request(start_response, response_body):
                    ('Content-Length', str(len(response_body)))])
     return [response_body.encode('utf-8')]
 
+# Metrics are kept by name and a tuple of (label, value) pairs
+def inccounter(name, labels=(), value=1):
+    metricslock.acquire()
+    metrictypes[name] = 'counter'
+    key = (name, labels)
+    counters[key] = counters.get(key, 0) + value
+    metricslock.release()
+
+def observe(name, labels, value, buckets=secondsbuckets):
+    metricslock.acquire()
+    metrictypes[name] = 'histogram'
+    key = (name, labels)
+    if key not in histograms:
+        histograms[key] = [buckets, [0] * len(buckets), 0, 0]
+    hist = histograms[key]
+    for i in range(len(buckets)):
+        if value <= buckets[i]:
+            hist[1][i] += 1
+    hist[2] += value
+    hist[3] += 1
+    metricslock.release()
+
+def formatlabels(labels):
+    if len(labels) == 0:
+        return ''
+    return '{' + ','.join([l + '="' + v + '"' for l, v in labels]) + '}'
+
+def formatmetrics(gauges, metricprefix='cvmfs_user_pub_'):
+    lines = []
+    # only one TYPE line is allowed per name, so group the samples
+    gaugenames = []
+    gaugesamples = {}
+    for name, labels, value in gauges:
+        if name not in gaugesamples:
+            gaugenames.append(name)
+            gaugesamples[name] = []
+        gaugesamples[name].append((labels, value))
+    for name in gaugenames:
+        lines.append('# TYPE ' + metricprefix + name + ' gauge')
+        for labels, value in gaugesamples[name]:
+            lines.append(metricprefix + name + formatlabels(labels) + ' ' +
+                            str(value))
+    metricslock.acquire()
+    for name in sorted(metrictypes):
+        lines.append('# TYPE ' + metricprefix + name + ' ' + metrictypes[name])
+        for key in sorted(counters):
+            if key[0] == name:
+                lines.append(metricprefix + name + formatlabels(key[1]) + ' ' +
+                                str(counters[key]))
+        for key in sorted(histograms):
+            if key[0] != name:
+                continue
+            buckets, counts, total, count = histograms[key]
+            for i in range(len(buckets)):
+                lines.append(metricprefix + name + '_bucket' +
+                    formatlabels(key[1] + (('le', str(buckets[i])),)) +
+                    ' ' + str(counts[i]))
+            lines.append(metricprefix + name + '_bucket' +
+                formatlabels(key[1] + (('le', '+Inf'),)) + ' ' + str(count))
+            lines.append(metricprefix + name + '_sum' +
+                            formatlabels(key[1]) + ' ' + str(total))
+            lines.append(metricprefix + name + '_count' +
+                            formatlabels(key[1]) + ' ' + str(count))
+    metricslock.release()
+    return '\n'.join(lines) + '\n'
+
+def metricgauges(snapshot):
+    gauges = [('service_running', (), int(servicerunning)),
+              ('config_age_seconds', (), time.time() - snapshot.loadtime),
+              ('queue_depth', (), pubqueue.qsize()),
+              ('publishing_cids', (), len(pubcids)),
+              ('pending_timestamps', (), len(tscids)),
+              ('cid_index_size', (), len(cidindex))]
+    for repo in sorted(repolocks):
+        gauges.append(('repo_busy', (('repo', repo),),
+                            int(repolocks[repo].locked())))
+    return gauges
+
+# Start tracing the stages that cid goes through, if enabled
+def starttrace(cid):
+    if tracefile != '':
+        traceids[cid] = uuid.uuid4().hex[0:16]
+
+def endtrace(cid):
+    traceids.pop(cid, None)
+
+# Queue a trace event for a stage of cid that ran from start to end.
+# Events are dropped rather than waiting if the writer falls behind.
+def tracespan(cid, span, start, end, repo=''):
+    traceid = traceids.get(cid)
+    if traceid is None:
+        return
+    event = {'trace': traceid, 'cid': cid, 'span': span,
+             'start': round(start, 6), 'end': round(end, 6),
+             'seconds': round(end - start, 6)}
+    if repo != '':
+        event['repo'] = repo
+    try:
+        tracequeue.put_nowait(event)
+    except queue.Full:
+        inccounter('trace_events_dropped_total')
+
+# Write queued trace events as lines of JSON, reopening the file if it
+#  gets rotated
+def traceloop():
+    threadmsg('thread started for writing trace events to ' + tracefile)
+    output = None
+    while True:
+        events = []
+        try:
+            events.append(tracequeue.get(True, 5))
+            while len(events) < 1000:
+                events.append(tracequeue.get(False))
+        except queue.Empty as e:
+            pass
+        if len(events) == 0:
+            continue
+        try:
+            if output is not None:
+                try:
+                    rotated = os.stat(tracefile).st_ino != \
+                                os.fstat(output.fileno()).st_ino
+                except OSError:
+                    rotated = True
+                if rotated:
+                    output.close()
+                    output = None
+            if output is None:
+                output = open(tracefile, 'a')
+            for event in events:
+                output.write(json.dumps(event, sort_keys=True) + '\n')
+            output.flush()
+        except Exception as e:
+            threadmsg('error writing ' + tracefile + ': ' + str(e))
+            output = None
+
 def parse_conf():
     global userpubconfmodtime
     newconf = {}
@@ -108,6 +394,7 @@ def parse_conf():
             return userpubconf
         userpubconfmodtime = modtime
         logmsg('-', '-', 'reading ' + userpubconffile)
+        inccounter('config_file_reads_total', (('file', 'conf'),))
         for line in open(userpubconffile, 'r').read().split('\n'):
             line = line.split('#',1)[0]  # removes comments
             words = line.split(None,1)
@@ -135,6 +422,7 @@ def parse_alloweddns():
             return alloweddns
         alloweddnsmodtime = modtime
         logmsg('-', '-', 'reading ' + alloweddnsfile)
+        inccounter('config_file_reads_total', (('file', 'grid-mapfile'),))
         for line in open(alloweddnsfile, 'r').read().split('\n'):
             # take the part between double quotes
             if len(line) == 0 or line[0] == '#':
@@ -160,6 +448,7 @@ def parse_issuers(issuersfile):
             return issuers
         issuersmodtime = modtime
         logmsg('-', '-', 'reading ' + issuersfile)
+        inccounter('config_file_reads_total', (('file', 'issuers'),))
         for line in open(issuersfile, 'r').read().split('\n'):
             # take the first whitespace-separated word
             if len(line) == 0 or line[0] == '#':
@@ -173,6 +462,87 @@ def parse_issuers(issuersfile):
 
     return newissuers
 
+# Forget the verified tokens, for when the accepted issuers or audiences
+#  change
+def cleartokencache(reason):
+    global tokengeneration
+    tokenlock.acquire()
+    tokengeneration += 1
+    if len(tokencache) > 0:
+        logmsg('-', '-', 'clearing ' + str(len(tokencache)) + \
+                ' cached tokens, ' + reason)
+        tokencache.clear()
+    tokenlock.release()
+
+# Return the claims needed from a bearer token.  Tokens are verified once
+#  and then kept in a least recently used cache, keyed by their hash,
+#  until they expire.
+def verifytoken(tokenstr):
+    key = hashlib.sha256(tokenstr.encode('utf-8')).hexdigest()
+    now = time.time()
+    tokenlock.acquire()
+    if key in tokencache:
+        claims = tokencache.pop(key)
+        if claims['exp'] > now:
+            tokencache[key] = claims
+            tokenlock.release()
+            inccounter('token_cache_total', (('result', 'hit'),))
+            return claims
+    generation = tokengeneration
+    tokenlock.release()
+    inccounter('token_cache_total', (('result', 'miss'),))
+    token = scitokens.SciToken.deserialize(tokenstr, audience=acceptedaudiences)
+    claims = {'iss': token['iss'], 'scope': token['scope'],
+                'sub': token['sub'], 'exp': 0}
+    try:
+        claims['exp'] = float(token['exp'])
+    except Exception:
+        pass
+    try:
+        # remember the key id so the key can be refreshed in the background
+        header = tokenstr.split('.')[0]
+        header += '=' * (-len(header) % 4)
+        kid = json.loads(base64.urlsafe_b64decode(header).decode('utf-8'))['kid']
+        tokenlock.acquire()
+        issuerkids.add((claims['iss'], kid))
+        tokenlock.release()
+    except Exception:
+        pass
+    if tokencachesize > 0 and claims['exp'] > now:
+        tokenlock.acquire()
+        if generation == tokengeneration:
+            tokencache[key] = claims
+            while len(tokencache) > tokencachesize:
+                tokencache.popitem(last=False)
+        tokenlock.release()
+    return claims
+
+# Refresh the public keys of the trusted issuers before they expire from
+#  the scitokens key cache, so verifying tokens doesn't have to wait for
+#  the issuers
+def issuerkeyloop():
+    threadmsg('thread started for refreshing issuer keys')
+    while True:
+        # read once, it may be changed by a config reload
+        refresh = issuerkeyrefresh
+        if refresh <= 0:
+            # startthreads() starts the thread again if it is re-enabled
+            threadmsg('issuer key refreshing disabled, thread exiting')
+            return
+        tokenlock.acquire()
+        kids = list(issuerkids)
+        tokenlock.release()
+        for issuer, kid in kids:
+            if issuer not in issuers:
+                continue
+            try:
+                KeyCache.getinstance().getkeyinfo(issuer, kid,
+                                                    force_refresh=True)
+            except Exception as e:
+                threadmsg('error refreshing key ' + kid + ' of ' + \
+                        issuer + ': ' + str(e))
+        time.sleep(refresh)
+
 # Generate all cids in the tree below path.  Cids can have zero or one
 #  slashes.  Assume they have zero slashes if the first subdirectory found
 #  has no .cvmfscatalog, otherwise assume they have one slash.  Cids of both
@@ -197,25 +567,46 @@ def findcids(path):
         if not hassubcatalog:
             yield upper
 
-# Return True if the cid and its timestamps are all older than maxdays.
-# Return False if not found, which can happen because there is a delay
-#  between publish and the time that updates appear in /cvmfs2.
-def cidexpired(cid, conf, now):
-    foundone = False
+# Walk the prefix and ts trees of every repo under /cvmfs2 once.
+# Returns a dictionary with the newest modification time of each cid's
+#  directory or timestamp in any repo, plus dictionaries per repo of
+#  the set of cids published there and the set of cids with timestamps
+#  there.  Cids only show up after a delay between publish and the time
+#  that updates appear in /cvmfs2.
+def scanmtimes(conf):
+    mtimes = {}
+    published = {}
+    stamped = {}
+    def newer(cid, path):
+        try:
+            mtime = os.path.getmtime(path)
+        except OSError:
+            return
+        if mtime > mtimes.get(cid, 0):
+            mtimes[cid] = mtime
     if 'hostrepo' in conf:
         for hostrepo in conf['hostrepo']:
             repo = hostrepo[hostrepo.find(':')+1:]
-            for pubdir in ['ts', prefix]:
-                path = '/cvmfs2/' + repo + '/' + pubdir + '/' + cid
-                if os.path.exists(path):
-                    foundone = True
-                    seconds = os.path.getmtime(path)
-                    days = int((now - seconds) / (60 * 60 * 24))
-                    if (days <= maxdays):
-                        return False
-    return foundone
-
-def runthreadcmd(cmd, msg):
+            published[repo] = set()
+            stamped[repo] = set()
+            cidpath = '/cvmfs2/' + repo + '/' + prefix
+            for cid in findcids(cidpath):
+                published[repo].add(cid)
+                newer(cid, cidpath + '/' + cid)
+            tspath = '/cvmfs2/' + repo + '/ts'
+            for dirpath, _, files in os.walk(tspath):
+                ciddir =  dirpath[len(tspath)+1:]
+                if ciddir != '':
+                    ciddir = ciddir + '/'
+                for file in files:
+                    cid = ciddir + file
+                    stamped[repo].add(cid)
+                    newer(cid, tspath + '/' + cid)
+    return mtimes, published, stamped
+
+# Run cmd in a shell, relaying its output.  If linefunc is given it is
+#  also called with each line of output.
+def runthreadcmd(cmd, msg, linefunc=None):
     threadmsg(cmd)
     p = subprocess.Popen( ('/bin/bash', '-c', cmd),
             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
@@ -234,6 +625,8 @@ def runthreadcmd(cmd, msg):
                     lines = data.split('\n')
                     for line in lines:
                         threadmsg(line)
+                        if linefunc is not None:
+                            linefunc(line)
                 elif p.returncode is not None:
                     ready = [x for x in ready if x is not fd]
         if p.poll() is not None and not ready:
@@ -245,11 +638,398 @@ def runthreadcmd(cmd, msg):
         threadmsg(msg + ' succeeded')
     return p.returncode
 
+def queuedsize(cid):
+    try:
+        return os.path.getsize(os.path.join(queuedir,cid))
+    except OSError:
+        return 0
+
+# The queue of publishes for the repo threads.  With the "smallfirst"
+#  schedpolicy, timestamps and tarballs up to smalljobmb (extracted,
+#  when validateuploads has counted it) are taken before bigger
+#  tarballs, and a big tarball is left for another repo thread that is
+#  waiting for work if that repo has been publishing faster recently
+#  (or has fewer cids when equal).  Anything that has waited more than
+#  maxqueuewait seconds is taken first regardless.
+#  The default "fifo" schedpolicy takes everything in order.
+# With fairshare, the choice within those rules goes round-robin
+#  between publishers, taking the oldest entry of the publisher that
+#  was served longest ago.
+class PubScheduler(queue.Queue):
+    def _init(self, maxsize):
+        # entries are [time queued, size, item, owning repo or None]
+        self.entries = []
+        self.waiting = set()
+        self.latencies = {}
+        self.served = {}
+        self.numserved = 0
+        self.tsdelay = None
+
+    def _qsize(self):
+        return len(self.entries)
+
+    def _put(self, item):
+        size = 0
+        owner = None
+        if 'queued' in item[3]:
+            size = queuedsize(item[0])
+            if item[0] in tarstats:
+                # the extracted size says more about the publish time
+                size = tarstats[item[0]][1]
+            owner = localowner(item[0])
+        self.entries.append([time.time(), size, item, owner])
+
+    def put(self, item, block=True, timeout=None):
+        queue.Queue.put(self, item, block, timeout)
+        # the first thread woken up might leave it for another
+        self.not_empty.acquire()
+        self.not_empty.notify_all()
+        self.not_empty.release()
+
+    def recordlatency(self, repo, seconds):
+        # exponentially weighted moving average of publish times
+        self.mutex.acquire()
+        if repo in self.latencies:
+            seconds = 0.8 * self.latencies[repo] + 0.2 * seconds
+        self.latencies[repo] = seconds
+        self.mutex.release()
+
+    def load(self, repo):
+        return (self.latencies.get(repo, 0), repocidcounts.get(repo, 0))
+
+    # Return the index of the entry that repo should take next, or None.
+    # Timestamp entries are left in the queue until timestampdelay() is
+    #  over, and self.tsdelay is set to how long that is.  Tarballs with
+    #  an owning repo are left for that repo.
+    def choose(self, repo):
+        self.tsdelay = None
+        indexes = []
+        for idx in range(len(self.entries)):
+            owner = self.entries[idx][3]
+            if repo is not None and owner is not None and owner != repo:
+                continue
+            if self.entries[idx][2][3] == 'ts':
+                if self.tsdelay is None:
+                    self.tsdelay = timestampdelay()
+                if self.tsdelay > 0:
+                    continue
+            indexes.append(idx)
+        if len(indexes) == 0:
+            return None
+        if schedpolicy != 'smallfirst':
+            return self.fairpick(indexes)
+        if (time.time() - self.entries[indexes[0]][0]) > maxqueuewait:
+            return indexes[0]
+        small = []
+        big = []
+        for idx in indexes:
+            if self.entries[idx][1] <= smalljobmb * 1024 * 1024:
+                small.append(idx)
+            else:
+                big.append(idx)
+        if len(small) > 0:
+            return self.fairpick(small)
+        if repo is not None and placement == 'any':
+            myload = self.load(repo)
+            for other in self.waiting:
+                if other != repo and self.load(other) < myload:
+                    return None
+        return self.fairpick(big)
+
+    def fairpick(self, indexes):
+        if not fairshare:
+            return indexes[0]
+        best = None
+        for idx in indexes:
+            served = self.served.get(self.entries[idx][2][1], 0)
+            if best is None or served < bestserved:
+                best = idx
+                bestserved = served
+        return best
+
+    def get(self, block=True, timeout=None):
+        repo = None
+        name = threading.current_thread().name
+        if name.startswith('Pub-'):
+            repo = name[4:]
+        if timeout is not None:
+            deadline = time.time() + timeout
+        self.not_empty.acquire()
+        try:
+            self.waiting.add(repo)
+            try:
+                while True:
+                    idx = self.choose(repo)
+                    if idx is not None:
+                        break
+                    if not block:
+                        raise queue.Empty
+                    if timeout is None:
+                        self.not_empty.wait(self.tsdelay)
+                    else:
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            raise queue.Empty
+                        if self.tsdelay is not None:
+                            remaining = min(remaining, self.tsdelay)
+                        self.not_empty.wait(remaining)
+            finally:
+                self.waiting.discard(repo)
+            queuedtime, size, item, owner = self.entries.pop(idx)
+            self.numserved += 1
+            self.served[item[1]] = self.numserved
+            self.not_full.notify()
+        finally:
+            self.not_empty.release()
+        if size <= smalljobmb * 1024 * 1024:
+            lane = 'small'
+        else:
+            lane = 'big'
+        observe('schedule_wait_seconds', (('lane', lane),),
+                    time.time() - queuedtime)
+        return item
+
+pubqueue = PubScheduler()
+
+# Rendezvous hash score of cid for repo according to the placement
+#  policy, either of the whole cid or of its project part before a slash
+def placementscore(repo, cid):
+    key = cid
+    if placement == 'project':
+        key = cid.split('/')[0]
+    digest = hashlib.sha1((repo + '/' + key).encode('utf-8')).hexdigest()
+    return int(digest[0:16], 16)
+
+# Return the local repo that cid is to be published in, or None if any
+#  repo can take it
+def localowner(cid):
+    if placement == 'any' or confsnapshot is None:
+        return None
+    best = None
+    for reponum, repo in confsnapshot.localrepos:
+        score = placementscore(repo, cid)
+        if best is None or score > bestscore:
+            best = repo
+            bestscore = score
+    return best
+
+# Return the repos to look for cid in, in order.  With a placement
+#  policy the repo that each host would have published it in comes
+#  first, ordered by their scores, then unless placementstrict the
+#  rest of the repos for cids published before the policy was set or
+#  the repos changed.
+def placementorder(cid, conf):
+    repos = []
+    if 'hostrepo' in conf:
+        for hostrepo in conf['hostrepo']:
+            colon = hostrepo.find(':')
+            repos.append((hostrepo[0:colon], hostrepo[colon+1:]))
+    if placement == 'any':
+        return [repo for host, repo in repos]
+    owners = {}
+    for host, repo in repos:
+        score = placementscore(repo, cid)
+        if host not in owners or score > owners[host][0]:
+            owners[host] = (score, repo)
+    first = [repo for score, repo in sorted(owners.values(), reverse=True)]
+    if placementstrict:
+        return first
+    return first + [repo for host, repo in repos if repo not in first]
+
+# Return how many more seconds the pending timestamps should wait for
+#  others to publish along with them, according to timestampwait and
+#  timestampmaxcids
+def timestampdelay():
+    if timestampwait <= 0:
+        return 0
+    tslock.acquire()
+    pending = [ts[2] for ts in tscids.values() if ts[0] == 1]
+    tslock.release()
+    if len(pending) == 0:
+        return 0
+    if timestampmaxcids > 0 and len(pending) >= timestampmaxcids:
+        return 0
+    return max(0, min(pending) + timestampwait - time.time())
+
+# Mark the pending timestamps as being published and return their cids
+#  and the publisher of the first one
+def takestamps():
+    cids = []
+    cn = '-'
+    tslock.acquire()
+    for tscid in tscids:
+        if tscids[tscid][0] == 1:
+            if len(cids) == 0:
+                cn = tscids[tscid][1]
+            cids.append(tscid)
+            # indicate that publish is in progress
+            tscids[tscid][0] = 2
+    tslock.release()
+    return cids, cn
+
+# Finish with timestamps from takestamps(), putting them back to be
+#  published again if publishing failed
+def finishstamps(cids, succeeded):
+    tslock.acquire()
+    for id in cids:
+        if succeeded:
+            del tscids[id]
+        else:
+            tscids[id][0] = 1
+    tslock.release()
+    if succeeded and runningpublisherd:
+        journalappend([{'op': 'stampdone', 'cid': id} for id in cids])
+
+# Collect more queued tarballs from pubqueue to publish in the same
+#  transaction as the first item, up to the batch limits from the
+#  configuration.  Timestamp items found along the way are put back.
+def collectbatch(first):
+    batch = [first]
+    if batchmaxcids <= 1:
+        return batch
+    cids = set([first[0]])
+    nbytes = queuedsize(first[0])
+    maxbytes = batchmaxmb * 1024 * 1024
+    deadline = time.time() + batchwait
+    putback = []
+    while len(batch) < batchmaxcids:
+        try:
+            timeout = deadline - time.time()
+            if timeout > 0:
+                item = pubqueue.get(True, timeout)
+            else:
+                item = pubqueue.get(False)
+        except queue.Empty as e:
+            break
+        if 'queued' not in item[3]:
+            putback.append(item)
+            continue
+        if item[0] in cids:
+            # duplicate, the one already in the batch covers it
+            pubqueue.task_done()
+            continue
+        size = queuedsize(item[0])
+        if maxbytes > 0 and nbytes + size > maxbytes:
+            putback.append(item)
+            break
+        cids.add(item[0])
+        nbytes += size
+        batch.append(item)
+    for item in putback:
+        pubqueue.put(item)
+        pubqueue.task_done()
+    if len(batch) > 1:
+        threadmsg('batching ' + str(len(batch)) + ' tarballs, ' + \
+                str(nbytes) + ' bytes')
+    return batch
+
+# Return a function for runthreadcmd that records how long each stage
+#  of the publish script took, from its "stage <name> done at <time>"
+#  lines, also tracing it for each of the cids being published.  The
+#  extraction throughput per compression format is also recorded, given
+#  the sizes of the cids.
+def stagetimer(repo, cids, sizes={}):
+    last = [time.time()]
+    def timestage(line):
+        words = line.split()
+        if len(words) == 7 and words[0] == 'extracted' and words[2] == 'format':
+            format = words[3]
+            try:
+                seconds = float(words[5])
+            except ValueError:
+                return
+            nbytes = sizes.get(words[1], 0)
+            labels = (('format', format),)
+            inccounter('extract_total', labels)
+            inccounter('extract_bytes_total', labels, nbytes)
+            inccounter('extract_seconds_total', labels, seconds)
+            if seconds > 0 and nbytes > 0:
+                observe('extract_bytes_per_second', labels,
+                            nbytes / seconds, ratebuckets)
+            return
+        if len(words) != 5 or words[0] != 'stage' or words[2:4] != ['done', 'at']:
+            return
+        try:
+            done = float(words[4])
+        except ValueError:
+            return
+        observe('publish_stage_seconds',
+                (('repo', repo), ('stage', words[1])), done - last[0])
+        for cid in cids:
+            tracespan(cid, words[1], last[0], done, repo)
+        last[0] = done
+    return timestage
+
+# Extract and publish a batch of queued tarballs in one transaction.
+# If the batch as a whole fails, fall back to publishing each of them
+#  separately so one bad tarball doesn't hold back the others.
+def publishtarballs(repo, batch):
+    cmd = "/usr/libexec/cvmfs-user-pub/publish "
+    # pending timestamps go along in the same transaction
+    stampcids, stampcn = takestamps()
+    if len(stampcids) > 0:
+        observe('timestamp_batch_size', (('repo', repo),),
+                    len(stampcids), countbuckets)
+        cmd += "-t '" + ','.join(stampcids) + "' '" + stampcn + "' "
+    cmd += repo + " " + queuedir + " " + prefix
+    cids = []
+    now = time.time()
+    for cid, cn, conf, option in batch:
+        # enclose cid and cn in single quotes because they come from the user
+        cmd += " '" + cid + "' '" + cn + "'"
+        cids.append(cid)
+        queuedtime = queuedtimes.pop(cid, None)
+        if queuedtime is not None:
+            observe('queue_wait_seconds', (('repo', repo),), now - queuedtime)
+            tracespan(cid, 'queue', queuedtime, now, repo)
+    observe('publish_batch_size', (('repo', repo),), len(batch), countbuckets)
+    sizes = {}
+    for cid in cids:
+        sizes[cid] = queuedsize(cid)
+    returncode = runthreadcmd(cmd, 'publish ' + ','.join(cids),
+                                stagetimer(repo, cids, sizes))
+    pubqueue.recordlatency(repo, time.time() - now)
+    if returncode == 0:
+        result = 'succeeded'
+    else:
+        result = 'failed'
+    inccounter('publishes_total', (('repo', repo), ('result', result)))
+    finishstamps(stampcids, returncode == 0)
+    if len(stampcids) > 0 and returncode != 0:
+        pubqueue.put([stampcids[0], stampcn, batch[0][2], 'ts'])
+    if returncode != 0 and len(batch) > 1:
+        threadmsg('batch publish failed, retrying ' + str(len(batch)) + \
+                ' tarballs one at a time')
+        for item in batch:
+            publishtarballs(repo, [item])
+        return
+    if returncode == 0:
+        requestsnapshot(repo)
+    for cid in cids:
+        if returncode == 0 and os.path.isdir(repocidpath(repo, cid)):
+            indexcid(cid, repo, True)
+        else:
+            now = time.time()
+            tracespan(cid, 'failed', now, now, repo)
+            endtrace(cid)
+            notifywaiters(cid, 'FAILED\n')
+        cidpath = os.path.join(queuedir,cid)
+        threadmsg('removing ' + cidpath)
+        try:
+            os.remove(cidpath)
+        except OSError:
+            threadmsg('removing ' + cidpath + ' failed, continuing')
+        donepublishing(cid)
+
 # do the operations on a cvmfs repository
 def publishloop(repo, reponum, conf):
     threadmsg('thread ' + str(reponum) + ' started for publishing to /cvmfs/' + repo)
-    gcdone = False
+    translock = repolocks[repo]
     while True:
+        # Don't take anything off the queue while cleanup or a streamed
+        #  publish is using this repo, leave it for the other repos
+        translock.acquire()
+        translock.release()
         cid = None
         try:
             cid, cn, conf, option = pubqueue.get(True, 60)
@@ -257,115 +1037,1111 @@ def publishloop(repo, reponum, conf):
             # cid will be None in this case
             pass
 
-        if cid is not None:
-            pubdir = prefix
-            cids = []
-            if 'ts' in option:
-                # This particular directory name 'ts' (for timestamp)
-                #  tells the publish script to only touch the file(s)
-                pubdir = 'ts'
-                # Publish together all timestamps in tscids that aren't
-                # being published by another thread.
-                # That list may be empty if they were already taken care of
-                # by another queued item.
-                tslock.acquire()
-                for tscid in tscids:
-                    if tscids[tscid] == 1:
-                        cids.append(tscid)
-                        # indicate that publish is in progress
-                        tscids[tscid] = 2
-                tslock.release()
-                cid = ','.join(cids)
+        if cid is not None and 'queued' in option:
+            batch = collectbatch([cid, cn, conf, option])
+            translock.acquire()
+            publishtarballs(repo, batch)
+            translock.release()
+            for item in batch:
+                pubqueue.task_done()
+        elif cid is not None:
+            # This particular directory name 'ts' (for timestamp)
+            #  tells the publish script to only touch the file(s)
+            pubdir = 'ts'
+            # Publish together all timestamps in tscids that aren't
+            # being published by another thread.
+            # That list may be empty if they were already taken care of
+            # by another queued item or a tarball publish.
+            cids, cn = takestamps()
+            cid = ','.join(cids)
             if cid != "":
+                observe('timestamp_batch_size', (('repo', repo),),
+                            len(cids), countbuckets)
                 # enclose cid in single quotes because it comes from the user
                 cmd = "/usr/libexec/cvmfs-user-pub/publish " + repo + " " + \
                         queuedir + " " + pubdir + " '" + cid + "' '" + cn + "'"
-                returncode = runthreadcmd(cmd, 'publish ' + cid)
-                if 'queued' in option:
-                    cidpath = os.path.join(queuedir,cid)
-                    threadmsg('removing ' + cidpath)
-                    os.remove(cidpath)
-                    publock.acquire()
-                    if cid in pubcids:
-                        del pubcids[cid]
-                    publock.release()
-                if len(cids) > 0:
-                    tslock.acquire()
-                    for id in cids:
-                        del tscids[id]
-                    tslock.release()
+                translock.acquire()
+                returncode = runthreadcmd(cmd, 'publish ' + cid,
+                                        stagetimer(repo, []))
+                translock.release()
+                finishstamps(cids, returncode == 0)
+                if returncode != 0:
+                    pubqueue.put([cids[0], cn, conf, 'ts'])
             pubqueue.task_done()
 
+# Remove a directory tree, first making sure that all of the
+#  directories in it are accessible and writable
+def removetree(path):
+    def makewritable(dirpath):
+        mode = os.lstat(dirpath).st_mode
+        if (mode & 0o700) != 0o700:
+            os.chmod(dirpath, mode | 0o700)
+    makewritable(path)
+    # subdirectories are fixed before os.walk descends into them
+    for dirpath, dirs, files in os.walk(path):
+        for dir in dirs:
+            makewritable(os.path.join(dirpath, dir))
+    shutil.rmtree(path)
+
+# Remove the directories of expired cids and the orphaned timestamp
+#  files in paths with gcthreads parallel threads, reporting progress.
+#  Returns the set of paths that were removed.
+def removepaths(repo, paths):
+    work = queue.Queue()
+    for path in paths:
+        work.put(path)
+    removed = set()
+    removedlock = threading.Lock()
+    def remover():
+        while True:
+            try:
+                path = work.get(False)
+            except queue.Empty as e:
+                return
+            threadmsg('removing ' + path)
+            try:
+                if os.path.isdir(path) and not os.path.islink(path):
+                    removetree(path)
+                else:
+                    os.remove(path)
+            except Exception as e:
+                threadmsg('removing ' + path + ' failed, continuing: ' + str(e))
+                continue
+            removedlock.acquire()
+            removed.add(path)
+            removedlock.release()
+    threads = []
+    for i in range(max(1, min(gcthreads, len(paths)))):
+        thread = threading.Thread(target=remover,
+                    name=threading.current_thread().name + '-' + str(i))
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        while thread.is_alive():
+            thread.join(10)
+            threadmsg('removed ' + str(len(removed)) + ' of ' + \
+                    str(len(paths)) + ' in ' + repo)
+    return removed
+
+# Delete expired cids and orphaned timestamps in repo and run gc.
+# The scan for what to delete is done without holding the repo's
+#  transaction lock, and the deletes are done in batches of at most
+#  gcbatchsize, releasing the lock in between so queued publishes
+#  can get in.
+def cleanuprepo(repo):
+    threadmsg('starting cleanup in ' + repo)
+    conf = userpubconf
+    translock = repolocks[repo]
+
+    cleanupsessions()
+
+    gcstart = time.time()
+    now = int(gcstart)
+    mtimes, published, stamped = scanmtimes(conf)
+    scantime = time.time() - gcstart
+    observe('gc_scan_seconds', (('repo', repo),), scantime)
+
+    # cids in this repo whose directory and timestamps in all repos
+    #  are older than maxdays
+    deletedcids = []
+    for cid in published.get(repo, ()):
+        days = int((now - mtimes.get(cid, now)) / (60 * 60 * 24))
+        if days > maxdays:
+            deletedcids.append(cid)
+    cidpath = '/cvmfs/' + repo + '/' + prefix
+    dirdeletelist = [cidpath + '/' + cid for cid in deletedcids]
+
+    # ts files in this repo that have no matching cid in any repo,
+    #  not counting those too recently published to be seen yet
+    allpublished = set()
+    for cids in published.values():
+        allpublished.update(cids)
+    tspath = '/cvmfs/' + repo + '/ts'
+    filedeletelist = [tspath + '/' + cid for cid in
+                        stamped.get(repo, set()) - allpublished
+                        if cidindex.get(cid) is None]
+
+    threadmsg('scanned ' + str(len(allpublished)) + ' cids and ' + \
+            str(sum([len(cids) for cids in stamped.values()])) + \
+            ' timestamps in ' + str(len(published)) + ' repos in ' + \
+            str(int(scantime)) + ' seconds, found ' + \
+            str(len(dirdeletelist)) + ' expired cids and ' + \
+            str(len(filedeletelist)) + ' orphaned timestamps in ' + repo)
+
+    deletes = list(zip(dirdeletelist, deletedcids)) + \
+                [(file, None) for file in filedeletelist]
+    batchsize = gcbatchsize
+    if batchsize <= 0:
+        batchsize = len(deletes)
+    deletedcidcount = 0
+    deletedfilecount = 0
+    for first in range(0, len(deletes), batchsize):
+        batch = deletes[first:first+batchsize]
+        translock.acquire()
+        threadmsg('starting transaction for ' + str(len(batch)) + \
+                ' deletes in ' + repo)
+        cmd = "cvmfs_server transaction '" + repo + "'"
+        if runthreadcmd(cmd, 'start transaction ' + repo) == 0:
+            removed = removepaths(repo, [path for path, cid in batch])
+            threadmsg('publishing deletes in ' + repo)
+            cmd = "cvmfs_server publish '" + repo + "'"
+            if runthreadcmd(cmd, 'publishing deletes ' + repo) == 0:
+                cids = [cid for path, cid in batch
+                            if cid is not None and path in removed]
+                unindexcids(cids, repo)
+                deletedcidcount += len(cids)
+                deletedfilecount += len(removed) - len(cids)
+        translock.release()
+
+    translock.acquire()
+    threadmsg('running gc on ' + repo)
+    cmd = "cvmfs_server gc -f '" + repo + "'"
+    runthreadcmd(cmd, 'gc ' + repo)
+    translock.release()
+    observe('gc_seconds', (('repo', repo),), time.time() - gcstart)
+    inccounter('gc_deleted_cids_total', (('repo', repo),), deletedcidcount)
+    inccounter('gc_deleted_timestamps_total', (('repo', repo),),
+                    deletedfilecount)
+
+# Do the daily cleanup of a cvmfs repository in its scheduled hour
+def gcloop(repo, reponum):
+    threadmsg('thread ' + str(reponum) + ' started for cleaning up /cvmfs/' + repo)
+    gcdone = False
+    while True:
+        time.sleep(60)
         thishour = datetime.datetime.now().hour
         if thishour != (gcstarthour - 1 + reponum) % 24:
             gcdone = False
+        elif not gcdone:
+            cleanuprepo(repo)
+            gcdone = True
+
+# Record that cid is published in repo.  If it was just published
+#  it might not be visible yet under /cvmfs2, so keep it in the index
+#  for a while even if a scan of the repo doesn't see it.
+def indexcid(cid, repo, justpublished=False):
+    indexlock.acquire()
+    cidindex[cid] = repo
+    missingcids.pop(cid, None)
+    if justpublished:
+        recentcids[cid] = time.time()
+    indexlock.release()
+
+def unindexcids(cids, repo):
+    indexlock.acquire()
+    for cid in cids:
+        if cidindex.get(cid) == repo:
+            del cidindex[cid]
+        if cid in recentcids:
+            del recentcids[cid]
+    indexlock.release()
+
+# Return the catalog revision of the replica of repo, or None if it
+#  cannot be read
+def reporevision(repo):
+    try:
+        return os.getxattr('/cvmfs2/' + repo, 'user.revision')
+    except Exception as e:
+        return None
+
+# Scan the prefix directory of repo under /cvmfs2 and replace the
+#  index entries for repo with what was found.  Returns the number found.
+def scanrepo(repo):
+    found = set(findcids('/cvmfs2/' + repo + '/' + prefix))
+    now = time.time()
+    indexlock.acquire()
+    for cid in [c for c in cidindex if cidindex[c] == repo]:
+        if cid in found:
             continue
-        if gcdone:
+        if cid in recentcids and (now - recentcids[cid]) < recentcidtime:
             continue
+        del cidindex[cid]
+    repocidcounts[repo] = len(found)
+    # the new revision may have any cid that was missing
+    missingcids.clear()
+    for cid in found:
+        cidindex[cid] = repo
+        if cid in recentcids:
+            # just published, now visible in /cvmfs2
+            tracespan(cid, 'replicate', recentcids[cid], now, repo)
+            endtrace(cid)
+            del recentcids[cid]
+    indexlock.release()
+    if len(waiters) > 0:
+        for cid in list(waiters):
+            # a wait for a dedup alias ends when its target shows up
+            target = cid
+            if target not in found:
+                target = aliastarget(cid)
+            if target is not None and target in found:
+                notifywaiters(cid,
+                        'PRESENT:' + repocidpath(repo, target) + '\n')
+    return len(found)
 
-        # time for cleanup too
-        threadmsg('starting cleanup in ' + repo)
-
-        now = int(time.time())
-        dirdeletelist = []
-        filedeletelist = []
-
-        # find expired cids in this repo, put on list to delete
-        cidpath = '/cvmfs/' + repo + '/' + prefix
-        for cid in findcids(cidpath):
-            if cidexpired(cid, conf, now):
-                dirdeletelist.append(cidpath + '/' + cid)
-
-        # find ts files in this repo that have no matching cid
-        tspath = '/cvmfs/' + repo + '/ts'
-        for dirpath, _, files in os.walk(tspath):
-            ciddir =  dirpath[len(tspath)+1:]
-            if ciddir != '':
-                ciddir = ciddir + '/'
-            for file in files:
-                cid = ciddir + file
-                if cidinrepo(cid, conf) is None:
-                    filedeletelist.append(tspath + '/' + cid)
-
-        if len(dirdeletelist) > 0 or len(filedeletelist) > 0:
-            threadmsg('starting transaction for deletes in ' + repo)
-            cmd = "cvmfs_server transaction '" + repo + "'"
-            if runthreadcmd(cmd, 'start transaction ' + repo) == 0:
-                for dir in dirdeletelist:
-                    cmd = "find " + dir + " -type d ! -perm -0700 -print0|xargs -0rt chmod u+rwx"
-                    runthreadcmd(cmd, 'checking perms on ' + dir)
-                    threadmsg('removing ' + dir)
-                    shutil.rmtree(dir)
-                for file in filedeletelist:
-                    threadmsg('removing ' + file)
-                    os.remove(file)
-                threadmsg('publishing deletes in ' + repo)
-                cmd = "cvmfs_server publish '" + repo + "'"
-                runthreadcmd(cmd, 'publishing deletes ' + repo)
-
-        threadmsg('running gc on ' + repo)
-        cmd = "cvmfs_server gc -f '" + repo + "'"
-        runthreadcmd(cmd, 'gc ' + repo)
-        gcdone = True
+# Keep the cid index up to date with the /cvmfs2 replicas, rescanning
+#  a repo whenever its catalog revision changes
+def indexloop():
+    threadmsg('thread started for indexing cids')
+    revisions = {}
+    while True:
+        conf = userpubconf
+        repos = set()
+        if 'hostrepo' in conf:
+            for hostrepo in conf['hostrepo']:
+                repos.add(hostrepo[hostrepo.find(':')+1:])
+        for repo in repos:
+            revision = reporevision(repo)
+            if revision is not None and revisions.get(repo) == revision:
+                continue
+            start = time.time()
+            try:
+                num = scanrepo(repo)
+            except Exception as e:
+                threadmsg('error indexing ' + repo + ': ' + str(e))
+                continue
+            revisions[repo] = revision
+            threadmsg('indexed ' + str(num) + ' cids in ' + repo + \
+                    ' in ' + str(int(time.time() - start)) + ' seconds')
+        now = time.time()
+        indexlock.acquire()
+        for cid in list(cidindex):
+            if cidindex[cid] not in repos:
+                del cidindex[cid]
+        for cid in list(recentcids):
+            if (now - recentcids[cid]) >= recentcidtime:
+                endtrace(cid)
+                del recentcids[cid]
+        indexlock.release()
+        interval = indexinterval
+        if len(waiters) > 0:
+            # check the revisions often while requests are waiting
+            interval = min(interval, 1)
+        indexwakeup.wait(interval)
+        indexwakeup.clear()
+
+# Return a local repo for cid whose publish thread is idle, holding its
+#  transaction lock, or None if there isn't one
+def claimidlerepo(cid):
+    if not pubqueue.empty():
+        return None
+    owner = localowner(cid)
+    for repo in list(repolocks):
+        if owner is not None and repo != owner:
+            continue
+        if repolocks[repo].acquire(False):
+            return repo
+    return None
+
+def relaylines(ip, cn, fd, linefunc):
+    for line in iter(fd.readline, b''):
+        line = line.decode('utf-8').rstrip('\n')
+        logmsg(ip, cn, line)
+        linefunc(line)
+
+# Copy length bytes of upload data into tmppath while also piping it
+#  into a publish of cid in repo, whose transaction lock must be held.
+# Returns True if it got published, or False if it still needs to be
+#  queued from tmppath.
+def streamupload(ip, cn, cid, repo, input, length, tmppath, hasher, format):
+    # the script can't look ahead in its input, so find the compression
+    #  format here, trusting the first bytes over what the client said
+    first = input.read(min(16384, length))
+    sniffed = sniffformat(first)
+    if format == '' or (sniffed != 'tar' and sniffed != format):
+        if format != '':
+            logmsg(ip, cn, cid + ' said to be ' + format + ' but is ' + sniffed)
+        format = sniffed
+    logmsg(ip, cn, 'streaming ' + format + ' ' + cid + ' into ' + repo)
+    # tar can't tell a tarball cut off between members from a whole one,
+    #  so the script waits for "commit" on this pipe before publishing
+    #  and aborts if the pipe is closed without it
+    controlread, controlwrite = os.pipe()
+    fcntl.fcntl(controlwrite, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+    kwargs = {}
+    if hasattr(os, 'set_inheritable'):
+        # python 3 closes other fds in the child by default
+        kwargs['pass_fds'] = (controlread,)
+    cmd = ['/usr/libexec/cvmfs-user-pub/publish', '-z', format,
+            '-w', str(controlread), repo, '-', prefix, cid, cn]
+    try:
+        p = subprocess.Popen(cmd, stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE, stderr=subprocess.STDOUT, **kwargs)
+    finally:
+        os.close(controlread)
+    relay = threading.Thread(target=relaylines, args=[ip, cn, p.stdout,
+                    stagetimer(repo, [cid], {cid: length})])
+    relay.start()
+    streaming = True
+    completed = False
+    try:
+        with open(tmppath, 'wb') as output:
+            while length > 0:
+                bufsize = 16384
+                if bufsize > length:
+                    bufsize = length
+                if first is not None:
+                    buf = first
+                    first = None
+                else:
+                    buf = input.read(bufsize)
+                if len(buf) == 0:
+                    raise IOError('publish data ended early')
+                output.write(buf)
+                if hasher is not None:
+                    hasher.update(buf)
+                if streaming:
+                    try:
+                        p.stdin.write(buf)
+                    except IOError as e:
+                        # extraction stopped, just finish the queue file
+                        logmsg(ip, cn, 'streaming ' + cid + ' stopped: ' + str(e))
+                        streaming = False
+                length -= len(buf)
+        completed = True
+    finally:
+        try:
+            p.stdin.close()
+        except IOError:
+            pass
+        if completed:
+            try:
+                os.write(controlwrite, b'commit\n')
+            except OSError:
+                # the script already failed
+                pass
+        os.close(controlwrite)
+        returncode = p.wait()
+        relay.join()
+    # tar may stop reading early at the end of the archive, so it is
+    #  the exit code that tells whether the publish worked
+    if returncode == 0:
+        result = 'succeeded'
+    else:
+        result = 'failed'
+    inccounter('streamed_publishes_total', (('repo', repo), ('result', result)))
+    if returncode != 0:
+        logmsg(ip, cn, 'streamed publish failed with code ' + \
+                str(returncode) + ', queueing ' + cid)
+        return False
+    os.remove(tmppath)
+    indexcid(cid, repo, True)
+    requestsnapshot(repo)
+    return True
+
+# Return the compression format of a tarball starting with buf
+def sniffformat(buf):
+    for magic, format in compressionmagic:
+        if buf.startswith(magic):
+            return format
+    return 'tar'
+
+# Check a tarball while it is being uploaded by parsing its headers as
+#  the data comes in, decompressing it if needed.  Rejects corrupt or
+#  truncated tarballs, paths that are absolute or contain "..",
+#  hardlinks to outside of the tree, and device and fifo files.  Also
+#  counts the files and their total size.  Formats that python can't
+#  decompress here are not checked.
+class TarValidator(object):
+    def __init__(self, format):
+        self.format = format
+        self.decompressor = None
+        self.started = False
+        self.checking = True
+        self.header = b''
+        self.skip = 0
+        self.capture = None
+        self.capturetype = None
+        self.capturesize = 0
+        self.zeroblocks = 0
+        self.done = False
+        self.longname = None
+        self.longlink = None
+        self.pax = {}
+        self.files = 0
+        self.size = 0
+        self.error = ''
+        self.kind = ''
+
+    def reject(self, kind, error):
+        if self.error == '':
+            self.kind = kind
+            self.error = error
+
+    def start(self, data):
+        self.started = True
+        sniffed = sniffformat(data)
+        if self.format == '' or sniffed != 'tar':
+            self.format = sniffed
+        if self.format in ('gzip', 'bzip2') or \
+                (self.format == 'xz' and lzma is not None) or \
+                (self.format == 'zstd' and zstandard is not None):
+            self.newdecompressor()
+        elif self.format != 'tar':
+            self.checking = False
+
+    def newdecompressor(self):
+        if self.format == 'gzip':
+            self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif self.format == 'bzip2':
+            self.decompressor = bz2.BZ2Decompressor()
+        elif self.format == 'xz':
+            self.decompressor = lzma.LZMADecompressor()
+        else:
+            self.decompressor = zstandard.ZstdDecompressor().decompressobj()
+
+    # decompress in pieces of limited size, in case of a compression bomb.
+    #  A file may hold several compressed streams one after the other, as
+    #  written by pigz or pbzip2, which decompress to a single tarball.
+    def decompressed(self, data):
+        if self.decompressor is None:
+            yield data
+            return
+        while len(data) > 0:
+            if getattr(self.decompressor, 'eof', False):
+                self.newdecompressor()
+            if self.format == 'gzip':
+                yield self.decompressor.decompress(data, 1048576)
+                data = self.decompressor.unconsumed_tail
+            elif hasattr(self.decompressor, 'needs_input'):
+                yield self.decompressor.decompress(data, 1048576)
+                data = b''
+                while not self.decompressor.needs_input and \
+                        not self.decompressor.eof:
+                    yield self.decompressor.decompress(b'', 1048576)
+            else:
+                yield self.decompressor.decompress(data)
+                data = b''
+            unused = getattr(self.decompressor, 'unused_data', b'')
+            if len(data) == 0 and len(unused) > 0:
+                # the rest is the start of the next stream
+                data = unused
+                self.newdecompressor()
+
+    def update(self, data):
+        if not self.started:
+            self.start(data)
+        if not self.checking or self.done or self.error != '':
+            return
+        try:
+            for piece in self.decompressed(data):
+                self.feed(piece)
+                if self.done or self.error != '':
+                    break
+        except Exception as e:
+            self.reject('corrupt', 'corrupt ' + self.format + ' data: ' + str(e))
+
+    def feed(self, data):
+        pos = 0
+        end = len(data)
+        while pos < end and not self.done and self.error == '':
+            if self.skip > 0:
+                n = min(self.skip, end - pos)
+                if self.capture is not None:
+                    self.capture.append(data[pos:pos+n])
+                self.skip -= n
+                pos += n
+                if self.skip == 0 and self.capture is not None:
+                    captured = b''.join(self.capture)[0:self.capturesize]
+                    self.capture = None
+                    self.special(self.capturetype, captured)
+                continue
+            n = min(512 - len(self.header), end - pos)
+            self.header += data[pos:pos+n]
+            pos += n
+            if len(self.header) == 512:
+                header = self.header
+                self.header = b''
+                self.member(header)
+
+    def member(self, header):
+        if header == b'\0' * 512:
+            self.zeroblocks += 1
+            if self.zeroblocks >= 2:
+                self.done = True
+            return
+        self.zeroblocks = 0
+        checksum = tarnumber(header[148:156])
+        if checksum != sum(bytearray(header[0:148])) + 256 + \
+                sum(bytearray(header[156:512])):
+            self.reject('checksum', 'bad tar header checksum')
+            return
+        type = header[156:157]
+        size = tarnumber(header[124:136])
+        if type in (b'L', b'K', b'x', b'g'):
+            if size > 1048576:
+                self.reject('header', 'tar extended header too large')
+                return
+            self.capture = []
+            self.capturetype = type
+            self.capturesize = size
+            self.skip = (size + 511) // 512 * 512
+            if self.skip == 0:
+                self.capture = None
+                self.special(type, b'')
+            return
+        name = header[0:100].split(b'\0')[0]
+        if header[257:262] == b'ustar':
+            prefix = header[345:500].split(b'\0')[0]
+            if prefix != b'':
+                name = prefix + b'/' + name
+        linkname = header[157:257].split(b'\0')[0]
+        if self.longname is not None:
+            name = self.longname
+        if self.longlink is not None:
+            linkname = self.longlink
+        name = self.pax.get('path', name)
+        linkname = self.pax.get('linkpath', linkname)
+        size = self.pax.get('size', size)
+        self.longname = None
+        self.longlink = None
+        self.pax = {}
+        if name.startswith(b'/') or b'..' in name.split(b'/'):
+            self.reject('path', 'path outside of the tree: ' + tarstr(name))
+        elif type == b'1' and (linkname.startswith(b'/') or \
+                    b'..' in linkname.split(b'/')):
+            self.reject('hardlink', 'hardlink outside of the tree: ' + \
+                    tarstr(name) + ' -> ' + tarstr(linkname))
+        elif type in (b'3', b'4', b'6'):
+            self.reject('special', 'device or fifo file: ' + tarstr(name))
+        if type in (b'1', b'2', b'3', b'4', b'5', b'6'):
+            # no data in the archive for these
+            size = 0
+        if type != b'5':
+            self.files += 1
+        self.size += size
+        self.skip = (size + 511) // 512 * 512
+
+    def special(self, type, data):
+        if type == b'L':
+            self.longname = data.split(b'\0')[0]
+        elif type == b'K':
+            self.longlink = data.split(b'\0')[0]
+        elif type == b'x':
+            # records are "<length> <key>=<value>\n"
+            pos = 0
+            while pos < len(data):
+                space = data.find(b' ', pos)
+                if space < 0:
+                    break
+                try:
+                    length = int(data[pos:space])
+                except ValueError:
+                    self.reject('header', 'bad tar extended header')
+                    return
+                if length <= 0:
+                    break
+                key, sep, value = data[space+1:pos+length-1].partition(b'=')
+                if key == b'path':
+                    self.pax['path'] = value
+                elif key == b'linkpath':
+                    self.pax['linkpath'] = value
+                elif key == b'size':
+                    self.pax['size'] = int(value)
+                pos += length
+
+    # Return the reason the tarball is invalid, or '' if it is ok
+    def finish(self):
+        if self.checking and self.error == '' and not self.done and \
+                (self.skip > 0 or len(self.header) > 0 or self.files == 0):
+            self.reject('truncated', 'truncated tarball')
+        return self.error
+
+def tarnumber(field):
+    if bytearray(field[0:1])[0:1] == bytearray(b'\x80'):
+        # base-256 for big numbers
+        number = 0
+        for byte in bytearray(field[1:]):
+            number = number * 256 + byte
+        return number
+    field = field.split(b'\0')[0].strip()
+    if field == b'':
+        return 0
+    return int(field, 8)
+
+def tarstr(name):
+    return name.decode('utf-8', 'replace')
+
+# Read the index of tarball content hashes.  Each line has a sha256
+#  digest and a cid, followed by "alias" if the cid was not published
+#  itself but only points to the cid last published with that digest.
+def load_hashindex():
+    global hashesloaded
+    hashlock.acquire()
+    if not hashesloaded:
+        hashesloaded = True
+        try:
+            if os.path.exists(hashindexfile):
+                logmsg('-', '-', 'reading ' + hashindexfile)
+                for line in open(hashindexfile, 'r').read().split('\n'):
+                    parts = line.split()
+                    if len(parts) < 2:
+                        continue
+                    cidhashes[parts[1]] = parts[0]
+                    if len(parts) == 2:
+                        hashcids[parts[0]] = parts[1]
+        except Exception as e:
+            logmsg('-', '-', 'error reading ' + hashindexfile + ', continuing: ' + str(e))
+    hashlock.release()
+
+def recordhash(digest, cid, alias):
+    line = digest + ' ' + cid
+    hashlock.acquire()
+    cidhashes[cid] = digest
+    if alias:
+        line += ' alias'
+    else:
+        hashcids[digest] = cid
+    try:
+        with open(hashindexfile, 'a') as output:
+            output.write(line + '\n')
+    except Exception as e:
+        logmsg('-', '-', 'error writing ' + hashindexfile + ', continuing: ' + str(e))
+    hashlock.release()
+
+# Return the cid that was published with the same content as cid,
+#  or None if there isn't a different one
+def aliastarget(cid):
+    digest = cidhashes.get(cid)
+    if digest is None:
+        return None
+    target = hashcids.get(digest)
+    if target == cid:
+        return None
+    return target
+
+# If the same content as cid was already published under another cid,
+#  record cid as an alias of that one, update its timestamp, and return
+#  the PRESENT response.  Otherwise record the digest for cid and
+#  return None.
+def dedupcid(ip, cn, cid, digest, conf):
+    target = hashcids.get(digest)
+    if target is not None and target != cid:
+        inrepo = cidinrepo(target, conf)
+        if inrepo is not None:
+            recordhash(digest, cid, True)
+            stamp(ip, cn, target, conf, ' in ' + inrepo + ', same content as ' + cid)
+            return 'PRESENT:' + repocidpath(inrepo, target) + '\n'
+    recordhash(digest, cid, False)
+    return None
+
+def countupload(nbytes, seconds):
+    inccounter('upload_bytes_total', (), nbytes)
+    observe('upload_seconds', (), seconds)
+    if seconds > 0:
+        observe('upload_bytes_per_second', (), nbytes / seconds, ratebuckets)
+
+# Return a name to upload cid into before renaming it to cidpath in
+#  queuedir, unique so that processes uploading the same cid don't mix
+#  their data
+def uploadtmppath(cidpath):
+    return cidpath + '.' + uuid.uuid4().hex[0:16] + '.tmp'
+
+# Return the response if cid is already publishing or present, so
+#  there is no need to upload it, otherwise None
+def skipupload(ip, cn, cid, conf):
+    publock.acquire()
+    if cid in pubcids or (publisherd and \
+                os.path.exists(os.path.join(queuedir,cid))):
+        publock.release()
+        logmsg(ip, cn, cid + ' already publishing, skipping')
+        return 'OK\n'
+    publock.release()
+    inrepo, presentcid = findcid(cid, conf)
+    if inrepo is not None:
+        stamp(ip, cn, presentcid, conf, ' in ' + inrepo + ', skipping upload')
+        return 'PRESENT:' + repocidpath(inrepo, presentcid) + '\n'
+    return None
+
+# Check the tarball stats gathered by validator.  Rejected uploads are
+#  cleaned up like failed uploads and the reason is returned, otherwise
+#  the stats are recorded for scheduling and '' is returned.
+def checkvalidated(ip, cn, cid, validator, tmppath):
+    reason = validator.finish()
+    if reason != '':
+        logmsg(ip, cn, cid + ' rejected: ' + reason)
+        inccounter('uploads_rejected_total', (('reason', validator.kind),))
+        endtrace(cid)
+        doneuploading(cn)
+        donepublishing(cid)
+        os.remove(tmppath)
+        return reason
+    if validator.checking:
+        tarstats[cid] = [validator.files, validator.size]
+        observe('upload_files', (), validator.files, filebuckets)
+        observe('upload_extracted_bytes', (), validator.size, bytebuckets)
+    return ''
+
+# Queue an uploaded tarball that has been renamed into queuedir, unless
+#  its sha256 in hasher shows that it is wrong or already published
+def queueupload(start_response, ip, cn, cid, conf, hasher):
+    if hasher is not None:
+        digest = hasher.hexdigest()
+        response = None
+        name = os.path.basename(cid)
+        if verifycidhash and re.match('^[0-9a-f]{64}$', name) and \
+                name != digest:
+            logmsg(ip, cn, cid + ' does not match sha256 ' + digest)
+            response = bad_request(start_response, ip, cn,
+                            'sha256 of tarball does not match cid')
+        elif dedupuploads:
+            body = dedupcid(ip, cn, cid, digest, conf)
+            if body is not None:
+                response = good_request(start_response, body)
+        if response is not None:
+            endtrace(cid)
+            cidpath = os.path.join(queuedir,cid)
+            logmsg(ip, cn, 'removing ' + cidpath)
+            os.remove(cidpath)
+            donepublishing(cid)
+            return response
+    return good_request(start_response, queueorstamp(ip, cn, cid, conf))
+
+# Upload sessions let big tarballs be sent in chunks, in parallel and
+#  resumed after errors.  Each session is a directory in sessiondir
+#  holding an "info" file with the cid, publisher, size and format, a
+#  sparse "data" file that the chunks are written into at their offsets,
+#  and a "ranges" file with a line "offset end" appended after each chunk
+#  is completely written.  The directories are shared by all the web
+#  service processes, and sessions not used for sessionexpirehours are
+#  removed by the daily cleanup.
+def createsession(cid, cn, size, format):
+    session = uuid.uuid4().hex
+    path = os.path.join(sessiondir, session)
+    if not os.path.exists(sessiondir):
+        os.mkdir(sessiondir)
+    os.mkdir(path)
+    with open(os.path.join(path, 'data'), 'wb') as output:
+        output.truncate(size)
+    info = {'cid': cid, 'cn': cn, 'size': size, 'format': format,
+            'created': time.time()}
+    with open(os.path.join(path, 'info.tmp'), 'w') as output:
+        output.write(json.dumps(info))
+    # the session exists once its info does
+    os.rename(os.path.join(path, 'info.tmp'), os.path.join(path, 'info'))
+    return session
+
+# Return the number of open upload sessions of cn and their total size
+def publishersessions(cn):
+    count = 0
+    size = 0
+    if not os.path.exists(sessiondir):
+        return count, size
+    for session in os.listdir(sessiondir):
+        try:
+            with open(os.path.join(sessiondir, session, 'info'), 'r') as input:
+                info = json.loads(input.read())
+        except (IOError, OSError, ValueError):
+            # being created, committed or expired
+            continue
+        if info['cn'] == cn:
+            count += 1
+            size += info['size']
+    return count, size
+
+# Check the publisher limits like reserveupload() before starting an
+#  upload session of size bytes for cn, so that sessions can't be used
+#  to get around them.  The open sessions are counted as uploads in
+#  progress and their sizes as queued data until they are committed or
+#  expire; the session directories are shared by all the web service
+#  processes, unlike the counts kept by reserveupload().
+def checksessionlimits(cn, size):
+    count, sessionbytes = publishersessions(cn)
+    now = time.time()
+    publock.acquire()
+    try:
+        uploads = publisheruploads.get(cn, 0) + count
+        if maxpublisheruploads > 0 and uploads >= maxpublisheruploads:
+            return 'too many uploads in progress', 60
+        queued = publisherbytes.get(cn, 0) + sessionbytes
+        if maxpublishermb > 0 and queued > 0 and \
+                queued + size > maxpublishermb * 1024 * 1024:
+            return 'too much data queued', 300
+        times = [t for t in publishertimes.get(cn, []) if (now - t) < 3600]
+        if maxpublisherperhour > 0 and len(times) >= maxpublisherperhour:
+            return 'too many publishes in the last hour', 3600 - (now - times[0])
+        return '', 0
+    finally:
+        publock.release()
+
+# Return the info and directory of the session in parameters that
+#  belongs to cn, and a reason if there isn't one
+def opensession(parameters, cn):
+    if 'session' not in parameters:
+        return None, None, 'No session given'
+    session = parameters['session'][0]
+    if not re.match('^[0-9a-f]{32}$', session):
+        return None, None, 'Malformed session'
+    path = os.path.join(sessiondir, session)
+    try:
+        with open(os.path.join(path, 'info'), 'r') as input:
+            info = json.loads(input.read())
+    except (IOError, OSError, ValueError):
+        return None, None, 'Unknown or expired upload session'
+    if info['cn'] != cn:
+        return None, None, 'Upload session belongs to another publisher'
+    return info, path, ''
+
+# Record that the bytes from offset up to end have arrived
+def addrange(path, offset, end):
+    # appends this small are atomic, so parallel chunks don't mix
+    with open(os.path.join(path, 'ranges'), 'a') as output:
+        output.write(str(offset) + ' ' + str(end) + '\n')
+
+# Return the sorted and merged [offset, end] ranges that have arrived
+def receivedranges(path):
+    ranges = []
+    try:
+        with open(os.path.join(path, 'ranges'), 'r') as input:
+            for line in input:
+                words = line.split()
+                if len(words) == 2:
+                    ranges.append([int(words[0]), int(words[1])])
+    except (IOError, OSError):
+        pass
+    ranges.sort()
+    merged = []
+    for offset, end in ranges:
+        if len(merged) > 0 and offset <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([offset, end])
+    return merged
+
+def formatranges(ranges):
+    return ','.join([str(offset) + '-' + str(end) for offset, end in ranges])
+
+def removesession(path):
+    shutil.rmtree(path, ignore_errors=True)
+
+# Remove the upload sessions that haven't been used for
+#  sessionexpirehours
+def cleanupsessions():
+    if not os.path.exists(sessiondir):
+        return
+    now = time.time()
+    expired = 0
+    for session in os.listdir(sessiondir):
+        path = os.path.join(sessiondir, session)
+        try:
+            lastused = os.path.getmtime(path)
+            for name in os.listdir(path):
+                lastused = max(lastused,
+                                os.path.getmtime(os.path.join(path, name)))
+        except OSError:
+            # committed or removed meanwhile
+            continue
+        if now - lastused > sessionexpirehours * 60 * 60:
+            removesession(path)
+            expired += 1
+    if expired > 0:
+        threadmsg('removed ' + str(expired) + ' expired upload sessions')
+        inccounter('upload_sessions_total', (('result', 'expired'),), expired)
 
 def cidinrepo(cid, conf):
-    if 'hostrepo' in conf:
-        for hostrepo in conf['hostrepo']:
-            repo = hostrepo[hostrepo.find(':')+1:]
-            if os.path.exists('/cvmfs2/' + repo + '/' + prefix + '/' + cid):
-                return repo
+    repo = cidindex.get(cid)
+    if repo is not None:
+        return repo
+    # Recently found missing?  Looking up missing paths is expensive
+    #  for cvmfs.  Entries are removed when a publish or a new revision
+    #  of a repo might have added the cid.
+    if missingcachetime > 0:
+        expires = missingcids.get(cid)
+        if expires is not None and expires > time.time():
+            inccounter('missing_cache_total', (('result', 'hit'),))
+            return None
+        inccounter('missing_cache_total', (('result', 'miss'),))
+    # not known to the index (yet), fall back to looking in the repos
+    for repo in placementorder(cid, conf):
+        if os.path.exists('/cvmfs2/' + repo + '/' + prefix + '/' + cid):
+            indexcid(cid, repo)
+            return repo
+    if missingcachetime > 0:
+        indexlock.acquire()
+        missingcids.pop(cid, None)
+        missingcids[cid] = time.time() + missingcachetime
+        while len(missingcids) > missingcachesize:
+            missingcids.popitem(last=False)
+        indexlock.release()
     return None
 
 def repocidpath(repo, cid):
     return '/cvmfs/' + repo + '/' + prefix + '/' + cid
 
+# Normalize a cid that came from the user and check that it is allowed.
+# Returns the normalized cid and a reason it is not allowed, or an
+#  empty reason if it is ok.
+def checkcid(cid):
+    cid = os.path.normpath(cid)
+    if cid[0] == '.':
+        return cid, 'cid may not start with "."'
+    if ("'" in cid) or ('\\' in cid):
+        # these are special to bash inside of single quotes
+        return cid, 'disallowed character in cid'
+    if cid.count('/') > 1:
+        # without this restriction it is challenging for cleanup
+        return cid, 'at most one slash allowed in cid'
+    return cid, ''
+
+# Return the repo that cid or the cid it is an alias of is published
+#  in, and that cid, or None and cid if it is not published
+def findcid(cid, conf):
+    inrepo = cidinrepo(cid, conf)
+    if inrepo is None:
+        target = aliastarget(cid)
+        if target is not None:
+            inrepo = cidinrepo(target, conf)
+            if inrepo is not None:
+                cid = target
+    return inrepo, cid
+
+# Ask for the replicas on this host to be snapshotted now, instead of
+#  waiting for the next snapshot from cron.  The snapshots script run
+#  by root picks up the request.
+def requestsnapshot(repo):
+    try:
+        with open(snapshotrequestfile, 'a') as output:
+            output.write(repo + '\n')
+    except Exception as e:
+        threadmsg('error requesting snapshot: ' + str(e))
+    indexwakeup.set()
+
+# Waiters are functions to call with the response body of a /wait
+#  request when its cid becomes visible in /cvmfs2 or fails to publish
+def addwaiter(cid, waiter):
+    waitlock.acquire()
+    waiters.setdefault(cid, []).append(waiter)
+    waitlock.release()
+    indexwakeup.set()
+
+def removewaiter(cid, waiter):
+    waitlock.acquire()
+    if cid in waiters and waiter in waiters[cid]:
+        waiters[cid].remove(waiter)
+        if len(waiters[cid]) == 0:
+            del waiters[cid]
+    waitlock.release()
+
+def notifywaiters(cid, body):
+    waitlock.acquire()
+    cidwaiters = waiters.pop(cid, [])
+    waitlock.release()
+    for waiter in cidwaiters:
+        waiter(body)
+
+# Return the response to a /wait for cid if there is one already, or
+#  None if it is still being published
+def waitstatus(cid, conf):
+    inrepo, presentcid = findcid(cid, conf)
+    if inrepo is not None and \
+            os.path.exists('/cvmfs2/' + inrepo + '/' + prefix + '/' + presentcid):
+        return 'PRESENT:' + repocidpath(inrepo, presentcid) + '\n'
+    if inrepo is not None or cid in pubcids or \
+            os.path.exists(os.path.join(queuedir, cid)):
+        return None
+    return 'MISSING\n'
+
+# Register waiter for cid and return the response if there already is
+#  one.  The waiter is registered first so that a notification can't be
+#  missed in between.
+def startwait(cid, conf, waiter):
+    addwaiter(cid, waiter)
+    body = waitstatus(cid, conf)
+    if body is not None:
+        removewaiter(cid, waiter)
+    return body
+
+# Each /wait that blocks holds one of the few web server threads, so
+#  only let maxblockingwaiters of them wait at once.  Returns False if
+#  there are already that many.
+def startblockingwait():
+    global blockingwaiters
+    waitlock.acquire()
+    started = blockingwaiters < maxblockingwaiters
+    if started:
+        blockingwaiters += 1
+    waitlock.release()
+    return started
+
+def endblockingwait():
+    global blockingwaiters
+    waitlock.acquire()
+    blockingwaiters -= 1
+    waitlock.release()
+
+# Look up cid for the exists and update apis, and for update also
+#  publish a timestamp if it is present.  Returns the response line.
+def lookupcid(ip, cn, cid, conf, update):
+    inrepo, cid = findcid(cid, conf)
+    if inrepo is not None:
+        if update:
+            stamp(ip, cn, cid, conf, ' in ' + inrepo + ', updating')
+        else:
+            logmsg(ip, cn, 'present in ' + inrepo + ': ' + cid)
+        return 'PRESENT:' + repocidpath(inrepo, cid) + '\n'
+    if update:
+        logmsg(ip, cn, cid + ' missing, skipping update')
+    else:
+        logmsg(ip, cn, cid + ' missing')
+    return 'MISSING\n'
+
+# Check the per-publisher limits for a new upload of length bytes from
+#  cn and reserve it against them.  Returns an empty reason if ok,
+#  otherwise the reason and how many seconds to wait before retrying.
+def reserveupload(cn, length):
+    now = time.time()
+    publock.acquire()
+    try:
+        times = [t for t in publishertimes.get(cn, []) if (now - t) < 3600]
+        publishertimes[cn] = times
+        if maxpublisheruploads > 0 and \
+                publisheruploads.get(cn, 0) >= maxpublisheruploads:
+            return 'too many uploads in progress', 60
+        if maxpublishermb > 0 and publisherbytes.get(cn, 0) > 0 and \
+                publisherbytes.get(cn, 0) + length > maxpublishermb * 1024 * 1024:
+            return 'too much data queued', 300
+        if maxpublisherperhour > 0 and len(times) >= maxpublisherperhour:
+            return 'too many publishes in the last hour', 3600 - (now - times[0])
+        publisheruploads[cn] = publisheruploads.get(cn, 0) + 1
+        publisherbytes[cn] = publisherbytes.get(cn, 0) + length
+        times.append(now)
+        return '', 0
+    finally:
+        publock.release()
+
+def doneuploading(cn):
+    publock.acquire()
+    publisheruploads[cn] -= 1
+    if publisheruploads[cn] == 0:
+        del publisheruploads[cn]
+    publock.release()
+
+# Remove cid from pubcids and the queued bytes of its publisher
+def donepublishing(cid):
+    publock.acquire()
+    if cid in pubcids:
+        cn, length = pubcids.pop(cid)
+        if cn in publisherbytes:
+            publisherbytes[cn] -= length
+            if publisherbytes[cn] <= 0:
+                del publisherbytes[cn]
+        if runningpublisherd:
+            journalappend([{'op': 'done', 'cid': cid}])
+    tarstats.pop(cid, None)
+    publock.release()
+
 def stamp(ip, cn, cid, conf, msg):
+    if publisherd and not runningpublisherd:
+        # the publisher daemon coalesces the timestamps
+        logmsg(ip, cn, cid + ' already present' + msg)
+        journalappend([{'op': 'stamp', 'cid': cid, 'cn': cn}])
+        notifypublisherd()
+        return
     tslock.acquire()
     if cid in tscids:
         tslock.release()
         logmsg(ip, cn, cid + ' already queued for timestamp, skipping')
     else:
-        tscids[cid] = 1
+        tscids[cid] = [1, cn, time.time()]
         tslock.release()
         logmsg(ip, cn, cid + ' already present' + msg)
         # although the cid is in the queue, the current contents of
@@ -376,6 +2152,8 @@ def queueorstamp(ip, cn, cid, conf):
     inrepo = cidinrepo(cid, conf)
     if inrepo is not None:
         stamp(ip, cn, cid, conf, ' in ' + inrepo)
+        endtrace(cid)
+        donepublishing(cid)
         cidpath = os.path.join(queuedir,cid)
         logmsg(ip, cn, 'removing ' + cidpath)
         try:
@@ -383,87 +2161,617 @@ def queueorstamp(ip, cn, cid, conf):
         except OSError:
             logmsg(ip, cn, 'removing ' + cidpath + ' failed, continuing')
         return 'PRESENT:' + repocidpath(inrepo, cid) + '\n'
+    if publisherd and not runningpublisherd:
+        record = {'op': 'queue', 'cid': cid, 'cn': cn}
+        if cid in tarstats:
+            record['files'], record['bytes'] = tarstats[cid]
+        # the rest of the trace is written by the publisher daemon
+        traceid = traceids.pop(cid, None)
+        if traceid is not None:
+            record['trace'] = traceid
+        journalappend([record])
+        notifypublisherd()
+        # from now on the file in queuedir shows that it is publishing
+        donepublishing(cid)
+        return 'OK\n'
+    queuedtimes[cid] = time.time()
     pubqueue.put([cid, cn, conf, 'queued'])
     return 'OK\n'
 
-def dispatch(environ, start_response):
-    if 'REMOTE_ADDR' not in environ:
-        logmsg('-', '-', 'No REMOTE_ADDR')
-        return bad_request(start_response, 'cvmfs-user-pub-dispatch', '-', 'REMOTE_ADDR not set')
-    ip = environ['REMOTE_ADDR']
+# Append records to the durable journal of queued publishes and
+#  timestamps that the web service processes share with the publisher
+#  daemon.  The file is locked while appending, and is reopened if the
+#  publisher daemon replaced it while compacting it.
+def journalappend(records):
+    data = ''
+    for record in records:
+        data += json.dumps(record, sort_keys=True) + '\n'
+    while True:
+        fd = os.open(journalfile, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                replaced = os.fstat(fd).st_ino != os.stat(journalfile).st_ino
+            except OSError:
+                replaced = True
+            if not replaced:
+                os.write(fd, data.encode('utf-8'))
+                os.fsync(fd)
+                return
+        finally:
+            os.close(fd)
+
+# Wake up the publisher daemon to read the journal.  If it isn't
+#  running it will read it when it starts.
+def notifypublisherd():
+    try:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(publishersocket)
+        sock.close()
+    except Exception as e:
+        logmsg('-', '-', 'could not notify publisher daemon: ' + str(e))
+
+def parsejournal(data):
+    records = []
+    for line in data.decode('utf-8').split('\n'):
+        if line == '':
+            continue
+        try:
+            records.append(json.loads(line))
+        except ValueError:
+            threadmsg('skipping bad journal line: ' + line)
+    return records
+
+# Read the journal, rewrite it with only the records that are still
+#  pending, and return those records and the size of the new journal
+def compactjournal():
+    fd = os.open(journalfile, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        data = b''
+        while True:
+            buf = os.read(fd, 1048576)
+            if len(buf) == 0:
+                break
+            data += buf
+        # leave out a partly written last line
+        data = data[0:data.rfind(b'\n')+1]
+        queued = {}
+        stamps = {}
+        order = []
+        for record in parsejournal(data):
+            op = record.get('op')
+            cid = record.get('cid')
+            # keep the first of repeated records, the one in order
+            if op == 'queue':
+                if cid not in queued:
+                    order.append(record)
+                    queued[cid] = record
+            elif op == 'done':
+                queued.pop(cid, None)
+            elif op == 'stamp':
+                if cid not in stamps:
+                    order.append(record)
+                    stamps[cid] = record
+            elif op == 'stampdone':
+                stamps.pop(cid, None)
+        pending = []
+        for record in order:
+            if record['op'] == 'queue' and queued.get(record['cid']) is record:
+                pending.append(record)
+            elif record['op'] == 'stamp' and stamps.get(record['cid']) is record:
+                pending.append(record)
+        newdata = ''
+        for record in pending:
+            newdata += json.dumps(record, sort_keys=True) + '\n'
+        newdata = newdata.encode('utf-8')
+        with open(journalfile + '.tmp', 'wb') as output:
+            output.write(newdata)
+            output.flush()
+            os.fsync(output.fileno())
+        os.rename(journalfile + '.tmp', journalfile)
+    finally:
+        os.close(fd)
+    threadmsg('compacted ' + journalfile + ' to ' + str(len(pending)) + \
+            ' pending records')
+    return pending, len(newdata)
 
-    now = int(time.time())
+# Return the complete records added to the journal after offset, and
+#  the offset after them
+def readjournal(offset):
+    with open(journalfile, 'rb') as input:
+        input.seek(offset)
+        data = input.read()
+    data = data[0:data.rfind(b'\n')+1]
+    return parsejournal(data), offset + len(data)
+
+# Queue the publishes and timestamps from journal records
+def handlejournal(records):
+    conf = userpubconf
+    for record in records:
+        op = record.get('op')
+        cid = record.get('cid')
+        cn = record.get('cn', '-')
+        if op == 'queue':
+            if cid in pubcids:
+                continue
+            if not os.path.exists(os.path.join(queuedir, cid)):
+                threadmsg(cid + ' no longer in ' + queuedir + ', skipping')
+                journalappend([{'op': 'done', 'cid': cid}])
+                continue
+            publock.acquire()
+            pubcids[cid] = [cn, 0]
+            if 'bytes' in record:
+                tarstats[cid] = [record['files'], record['bytes']]
+            if 'trace' in record and tracefile != '':
+                traceids[cid] = record['trace']
+            publock.release()
+            msg = queueorstamp('-', cn, cid, conf)
+            threadmsg('queued ' + cid + ': ' + msg.strip())
+        elif op == 'stamp':
+            stamp('-', cn, cid, conf, ', updating')
 
+# Write the daemon's metrics where the web service adds them to its own,
+#  with a different prefix so the names don't clash
+def writepublishermetrics():
+    snapshot = confsnapshot
+    tmpfile = publishermetricsfile + '.tmp'
+    try:
+        with open(tmpfile, 'w') as output:
+            output.write(formatmetrics(metricgauges(snapshot),
+                                        'cvmfs_user_pubd_'))
+        os.rename(tmpfile, publishermetricsfile)
+    except (IOError, OSError) as e:
+        threadmsg('error writing ' + publishermetricsfile + ': ' + str(e))
+
+def stoppublisherd(signum, frame):
+    global stoppingpublisherd
+    stoppingpublisherd = True
+
+# Run as the publisher daemon.  It does the publishing and cleanup
+#  instead of the web service processes, which queue work by appending
+#  to the journal and then notifying it through a unix socket.  On
+#  startup it picks up whatever was pending in the journal.  On SIGTERM
+#  it stops reading the journal and exits once what it has queued is
+#  published, without leaving a transaction open.
+def publisherdaemon():
+    global runningpublisherd
+    runningpublisherd = True
+    threading.current_thread().name = 'Publisherd'
+    threadmsg('starting publisher daemon')
+    reloadconf()
+    if not os.path.exists(queuedir):
+        os.mkdir(queuedir)
+    newjournal = not os.path.exists(journalfile)
+    pending, offset = compactjournal()
+    if newjournal:
+        # pick up anything queued before there was a publisher daemon
+        for root, dirs, files in os.walk(queuedir):
+            for file in files:
+                if not file.endswith('.tmp'):
+                    path = root + '/' + file
+                    pending.append({'op': 'queue', 'cn': 'Requeue',
+                                    'cid': path[len(queuedir)+1:]})
+    handlejournal(pending)
+
+    if os.path.exists(publishersocket):
+        os.remove(publishersocket)
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(publishersocket)
+    listener.listen(64)
+    signal.signal(signal.SIGTERM, stoppublisherd)
+    compactedsize = offset
+    while not stoppingpublisherd:
+        try:
+            ready, _, _ = select.select([listener], [], [], 5)
+        except select.error:
+            # interrupted by a signal in python 2
+            continue
+        if ready:
+            conn, _ = listener.accept()
+            conn.close()
+        records, offset = readjournal(offset)
+        handlejournal(records)
+        if offset > 2 * compactedsize + 1048576:
+            # records appended since the last read are among those
+            #  pending, and handling the rest again skips them
+            pending, offset = compactjournal()
+            compactedsize = offset
+            handlejournal(pending)
+        writepublishermetrics()
+
+    threadmsg('stopping, waiting for queued publishes to finish')
+    listener.close()
+    pubqueue.join()
+    for repo in list(repolocks):
+        # keep cleanup from starting another transaction
+        repolocks[repo].acquire()
+    threadmsg('publisher daemon stopped')
+    # the other threads never return
+    os._exit(0)
+
+# Return whether the cvmfs-user-pub service is active.  Its init script
+#  writes servicestatefile while it is; if the file is missing, check
+#  with systemd in case the service was started by an older init script.
+def serviceactive():
+    if os.path.exists(servicestatefile):
+        return True
+    cmd = "systemctl is-active --quiet cvmfs-user-pub"
+    p = subprocess.Popen(cmd, shell=True)
+    return p.wait() == 0
+
+def serviceup(ip):
+    global servicerunning
     conflock.acquire()
-    global confupdatetime
-    global userpubconf
-    if (now - confupdatetime) > confcachetime:
-        confupdatetime = now
-        if len(userpubconf) != 0:
-            # release if not reading for the first time, to
-            #   let other threads continue to use the old copy
-            conflock.release()
-        newconf = parse_conf()
-        newdns = parse_alloweddns()
-        newissuers = set()
-        if 'issuersfile' in newconf:
-            newissuers = parse_issuers(newconf['issuersfile'][0])
-
-        global audiences
-        if 'audience' in newconf:
-            for a in newconf['audience']:
-                audiences.add(a)
-
-        # things to do when config file has changed
-        global queuedir
-        if 'queuedir' in newconf:
-            queuedir = newconf['queuedir'][0]
-
-        global prefix
-        if 'prefix' in newconf:
-            prefix = newconf['prefix'][0]
-
-        global gcstarthour
-        if 'gcstarthour' in newconf:
-            gcstarthour = int(newconf['gcstarthour'][0])
-
-        global maxdays
-        if 'maxdays' in newconf:
-            maxdays = int(newconf['maxdays'][0])
-
-        if 'hostrepo' in newconf:
-            myhost = socket.gethostname()
-            myshorthost = myhost.split('.')[0]
-            reponum = 0
-            for hostrepo in newconf['hostrepo']:
-                reponum += 1
-                colon = hostrepo.find(':')
-                host = hostrepo[0:colon]
-                repo = hostrepo[colon+1:]
-                if host != myhost and host != myshorthost:
+    wasrunning = servicerunning
+    servicerunning = True
+    conflock.release()
+    if wasrunning:
+        return
+    logmsg(ip, '-', 'Service is now up')
+    thread = threading.Thread(name='Requeue', target=requeueloop,
+                              args=[userpubconf])
+    thread.start()
+
+def checkservice():
+    global servicerunning
+    global servicestatustime
+    servicestatustime = time.time()
+    # can't depend on an api request, because httpd might be reloaded
+    if serviceactive():
+        serviceup('-')
+    elif servicerunning:
+        # normally the shutdown request comes soon after this
+        servicerunning = False
+        threadmsg('Service is now down')
+
+# Keep track of whether the service is running, so requests don't have
+#  to check
+def servicewatchloop():
+    threadmsg('thread started for watching the service state')
+    while True:
+        time.sleep(servicecachetime)
+        checkservice()
+
+# Re-queue any tarballs left over from before the service was up
+def requeueloop(conf):
+    now = time.time()
+    for root, dirs, files in os.walk(queuedir):
+        for file in files:
+            path = root + '/' + file
+            if file.endswith('.tmp'):
+                # other processes may still be uploading into recent ones
+                try:
+                    if now - os.path.getmtime(path) > staletmptime:
+                        threadmsg('cleaning out ' + path)
+                        os.remove(path)
+                except OSError:
+                    pass
+            elif not publisherd:
+                # otherwise the publisher daemon has them
+                cid = path[len(queuedir)+1:]
+                publock.acquire()
+                if cid in pubcids:
+                    # queued again since the service came up
+                    publock.release()
                     continue
-                pubrepo = 'Pub-' + repo
-                gotit = False
-                for thread in threading.enumerate():
-                    if thread.name == pubrepo:
-                        gotit = True
-                        break
-                if not gotit:
-                    thread = threading.Thread(name=pubrepo,
-                                              target=publishloop,
-                                              args=[repo, reponum, newconf])
-                    thread.start()
+                pubcids[cid] = ['Requeue', 0]
+                publock.release()
+                msg = queueorstamp('-', 'Requeue', cid, conf)
+                threadmsg('Requeued ' + cid + ': ' + msg.strip())
 
-        if len(userpubconf) != 0:
-            conflock.acquire()
-        userpubconf = newconf
-        global alloweddns
-        alloweddns = newdns
-        global issuers
-        issuers = newissuers
-    conf = userpubconf
-    dns = alloweddns
+# An immutable view of the configuration, replaced as a whole by
+#  reloadconf() so that requests can use it without locking
+ConfSnapshot = collections.namedtuple('ConfSnapshot',
+        ['conf', 'dns', 'issuers', 'audiences', 'localrepos', 'loadtime'])
+
+# Return the (reponum, repo) of the hostrepos on this host
+def findlocalrepos(conf):
+    localrepos = []
+    if 'hostrepo' in conf:
+        myhost = socket.gethostname()
+        myshorthost = myhost.split('.')[0]
+        reponum = 0
+        for hostrepo in conf['hostrepo']:
+            reponum += 1
+            colon = hostrepo.find(':')
+            host = hostrepo[0:colon]
+            repo = hostrepo[colon+1:]
+            if host == myhost or host == myshorthost:
+                localrepos.append((reponum, repo))
+    return localrepos
+
+# Reread the configuration files that changed and swap in a new snapshot
+#  if anything did.  The files are only read when their modification
+#  times change.
+def reloadconf():
+    global confsnapshot
+    global userpubconf
+    global alloweddns
+    global issuers
+    conflock.acquire()
+    start = time.time()
+    newconf = parse_conf()
+    newdns = parse_alloweddns()
+    newissuers = set()
+    if 'issuersfile' in newconf:
+        newissuers = parse_issuers(newconf['issuersfile'][0])
+    snapshot = confsnapshot
+    if snapshot is not None and newconf is snapshot.conf and \
+            newdns is snapshot.dns and newissuers == snapshot.issuers:
+        conflock.release()
+        inccounter('config_reloads_total', (('result', 'unchanged'),))
+        return snapshot
+
+    setconfglobals(newconf)
+    if newissuers != issuers:
+        cleartokencache('issuers changed')
+    userpubconf = newconf
+    alloweddns = newdns
+    issuers = newissuers
+    snapshot = ConfSnapshot(newconf, newdns, newissuers, audiences,
+                            findlocalrepos(newconf), time.time())
+    confsnapshot = snapshot
+    startthreads(snapshot)
     conflock.release()
+    inccounter('config_reloads_total', (('result', 'changed'),))
+    observe('config_reload_seconds', (), time.time() - start)
+    return snapshot
+
+def confloop():
+    threadmsg('thread started for reloading the configuration')
+    while True:
+        time.sleep(confcheckinterval)
+        try:
+            reloadconf()
+        except Exception as e:
+            threadmsg('error reloading configuration: ' + str(e))
+
+# Set the global settings from a newly read configuration
+def setconfglobals(newconf):
+    global audiences
+    global acceptedaudiences
+    newaudiences = set()
+    if 'audience' in newconf:
+        newaudiences = set(newconf['audience'])
+    if len(acceptedaudiences) == 0 or newaudiences != audiences:
+        audiences = newaudiences
+        newaccepted = ["https://wlcg.cern.ch/jwt/v1/any"]
+        if len(audiences) == 0:
+            newaccepted.append("https://"+socket.gethostname())
+        else:
+            newaccepted.extend(sorted(audiences))
+        acceptedaudiences = newaccepted
+        cleartokencache('audiences changed')
+
+    global tokencachesize
+    if 'tokencachesize' in newconf:
+        tokencachesize = int(newconf['tokencachesize'][0])
+
+    global issuerkeyrefresh
+    if 'issuerkeyrefresh' in newconf:
+        issuerkeyrefresh = int(newconf['issuerkeyrefresh'][0])
+
+    global queuedir
+    if 'queuedir' in newconf:
+        queuedir = newconf['queuedir'][0]
+
+    global sessiondir
+    sessiondir = queuedir + '.sessions'
+    if 'sessiondir' in newconf:
+        sessiondir = newconf['sessiondir'][0]
+
+    global sessionexpirehours
+    if 'sessionexpirehours' in newconf:
+        sessionexpirehours = int(newconf['sessionexpirehours'][0])
+
+    global prefix
+    if 'prefix' in newconf:
+        prefix = newconf['prefix'][0]
+
+    global gcstarthour
+    if 'gcstarthour' in newconf:
+        gcstarthour = int(newconf['gcstarthour'][0])
+
+    global confcheckinterval
+    if 'confcheckinterval' in newconf:
+        confcheckinterval = int(newconf['confcheckinterval'][0])
+
+    global maxdays
+    if 'maxdays' in newconf:
+        maxdays = int(newconf['maxdays'][0])
+
+    global batchmaxcids
+    if 'batchmaxcids' in newconf:
+        batchmaxcids = int(newconf['batchmaxcids'][0])
+
+    global batchmaxmb
+    if 'batchmaxmb' in newconf:
+        batchmaxmb = int(newconf['batchmaxmb'][0])
+
+    global timestampwait
+    if 'timestampwait' in newconf:
+        timestampwait = int(newconf['timestampwait'][0])
+
+    global timestampmaxcids
+    if 'timestampmaxcids' in newconf:
+        timestampmaxcids = int(newconf['timestampmaxcids'][0])
+
+    global batchwait
+    if 'batchwait' in newconf:
+        batchwait = int(newconf['batchwait'][0])
+
+    global gcbatchsize
+    if 'gcbatchsize' in newconf:
+        gcbatchsize = int(newconf['gcbatchsize'][0])
+
+    global gcthreads
+    if 'gcthreads' in newconf:
+        gcthreads = int(newconf['gcthreads'][0])
+
+    global schedpolicy
+    if 'schedpolicy' in newconf:
+        schedpolicy = newconf['schedpolicy'][0]
+
+    global smalljobmb
+    if 'smalljobmb' in newconf:
+        smalljobmb = int(newconf['smalljobmb'][0])
+
+    global maxqueuewait
+    if 'maxqueuewait' in newconf:
+        maxqueuewait = int(newconf['maxqueuewait'][0])
+
+    global placement
+    if 'placement' in newconf:
+        placement = newconf['placement'][0]
+
+    global placementstrict
+    if 'placementstrict' in newconf:
+        placementstrict = (newconf['placementstrict'][0] == 'true')
+
+    global fairshare
+    if 'fairshare' in newconf:
+        fairshare = (newconf['fairshare'][0] == 'true')
+
+    global maxpublisheruploads
+    if 'maxpublisheruploads' in newconf:
+        maxpublisheruploads = int(newconf['maxpublisheruploads'][0])
+
+    global maxpublishermb
+    if 'maxpublishermb' in newconf:
+        maxpublishermb = int(newconf['maxpublishermb'][0])
+
+    global maxpublisherperhour
+    if 'maxpublisherperhour' in newconf:
+        maxpublisherperhour = int(newconf['maxpublisherperhour'][0])
+
+    global maxwaittimeout
+    if 'maxwaittimeout' in newconf:
+        maxwaittimeout = int(newconf['maxwaittimeout'][0])
+
+    global maxblockingwaiters
+    if 'maxblockingwaiters' in newconf:
+        maxblockingwaiters = int(newconf['maxblockingwaiters'][0])
+
+    global missingcachetime
+    if 'missingcachetime' in newconf:
+        missingcachetime = int(newconf['missingcachetime'][0])
+
+    global missingcachesize
+    if 'missingcachesize' in newconf:
+        missingcachesize = int(newconf['missingcachesize'][0])
+
+    global indexinterval
+    if 'indexinterval' in newconf:
+        indexinterval = int(newconf['indexinterval'][0])
+
+    global streamuploads
+    if 'streamuploads' in newconf:
+        streamuploads = (newconf['streamuploads'][0] == 'true')
+
+    global dedupuploads
+    if 'dedupuploads' in newconf:
+        dedupuploads = (newconf['dedupuploads'][0] == 'true')
+
+    global verifycidhash
+    if 'verifycidhash' in newconf:
+        verifycidhash = (newconf['verifycidhash'][0] == 'true')
+
+    global validateuploads
+    if 'validateuploads' in newconf:
+        validateuploads = (newconf['validateuploads'][0] == 'true')
+
+    global hashindexfile
+    if 'hashindexfile' in newconf:
+        hashindexfile = newconf['hashindexfile'][0]
+
+    global tracefile
+    if 'tracefile' in newconf:
+        tracefile = newconf['tracefile'][0]
+
+    global publisherd
+    if 'publisherd' in newconf:
+        publisherd = (newconf['publisherd'][0] == 'true')
+
+    global journalfile
+    if 'journalfile' in newconf:
+        journalfile = newconf['journalfile'][0]
+
+    global publishersocket
+    if 'publishersocket' in newconf:
+        publishersocket = newconf['publishersocket'][0]
+
+    global publishermetricsfile
+    if 'publishermetricsfile' in newconf:
+        publishermetricsfile = newconf['publishermetricsfile'][0]
+
+    global servicestatefile
+    if 'servicestatefile' in newconf:
+        servicestatefile = newconf['servicestatefile'][0]
+
+    if dedupuploads:
+        load_hashindex()
+
+# Start the threads needed for newconf that aren't already running.
+# The publish and cleanup threads run in the separate publisher daemon
+#  instead of in the web service if that is configured.
+def startthreads(snapshot):
+    running = set([thread.name for thread in threading.enumerate()])
+    if runningpublisherd or not publisherd:
+        for reponum, repo in snapshot.localrepos:
+            if repo not in repolocks:
+                repolocks[repo] = threading.Lock()
+            pubrepo = 'Pub-' + repo
+            if pubrepo not in running:
+                thread = threading.Thread(name=pubrepo,
+                                          target=publishloop,
+                                          args=[repo, reponum, snapshot.conf])
+                thread.start()
+                thread = threading.Thread(name='Gc-' + repo,
+                                          target=gcloop,
+                                          args=[repo, reponum])
+                thread.start()
+
+    loops = [('Config', confloop)]
+    if 'hostrepo' in snapshot.conf:
+        loops.append(('CidIndex', indexloop))
+    if len(snapshot.issuers) > 0 and KeyCache is not None and \
+            issuerkeyrefresh > 0:
+        loops.append(('IssuerKeys', issuerkeyloop))
+    if not runningpublisherd:
+        loops.append(('Service', servicewatchloop))
+    if tracefile != '':
+        loops.append(('Trace', traceloop))
+    for name, target in loops:
+        if name not in running:
+            thread = threading.Thread(name=name, target=target)
+            thread.start()
+
+def dispatch(environ, start_response):
+    status = []
+    def countstatus(response_code, headers):
+        status.append(response_code.split()[0])
+        return start_response(response_code, headers)
+    response = dispatchapi(environ, countstatus)
+    api = environ.get('PATH_INFO', '')[1:]
+    if api not in metricapis:
+        api = 'other'
+    if len(status) > 0:
+        inccounter('requests_total', (('api', api), ('code', status[0])))
+    return response
+
+def dispatchapi(environ, start_response):
+    if 'REMOTE_ADDR' not in environ:
+        logmsg('-', '-', 'No REMOTE_ADDR')
+        return bad_request(start_response, 'cvmfs-user-pub-dispatch', '-', 'REMOTE_ADDR not set')
+    ip = environ['REMOTE_ADDR']
+
+    snapshot = confsnapshot
+    if snapshot is None:
+        # first request in this process, later reloads are in the background
+        snapshot = reloadconf()
+    conf = snapshot.conf
+    dns = snapshot.dns
 
     if 'PATH_INFO' not in environ:
         return bad_request(start_response, ip, '-', 'No PATH_INFO')
@@ -474,62 +2782,46 @@ def dispatch(environ, start_response):
         parameters = parse_qs(unquote(environ['QUERY_STRING']))
 
     global servicerunning
-    global servicestatustime
-
-    startup = False
     if ip == "127.0.0.1":
         if pathinfo == '/startup':
             # The cvmfs-user-pub service is about to become active
-            startup = True
+            serviceup(ip)
+            return good_request(start_response, 'OK\n')
         elif pathinfo == '/shutdown':
-            if servicerunning:
-                servicerunning = False
+            conflock.acquire()
+            wasrunning = servicerunning
+            servicerunning = False
+            conflock.release()
+            if wasrunning:
                 logmsg(ip, '-', 'Service shutting down')
-                # wait for publication processes to finish
-                pubqueue.join()
+            # wait for publication processes to finish.  With publisherd
+            #  they are in the daemon, which is stopped before this
+            #  service and waits for them itself.
+            pubqueue.join()
+            for repo in list(repolocks):
+                # any streamed publishes
+                repolocks[repo].acquire()
+                repolocks[repo].release()
             return good_request(start_response, 'OK\n')
 
-    conflock.acquire()
-    if startup or (now - servicestatustime) > servicecachetime:
-        servicestatustime = now
-        conflock.release()
-        if startup:
-            isactivecode = 0
-        else:
-            # check if the service is running
-            # can't depend on an api request, because httpd might be reloaded
-            cmd = "systemctl is-active --quiet cvmfs-user-pub"
-            p = subprocess.Popen(cmd, shell=True)
-            isactivecode = p.wait()
-        if isactivecode == 0:
-            if not servicerunning:
-                servicerunning = True
-                logmsg(ip, '-', 'Service is now up')
-                # re-queue any leftover tarfiles
-                for root, dirs, files in os.walk(queuedir):
-                    for file in files:
-                        path = root + '/' + file
-                        if file.endswith('.tmp'):
-                            logmsg(ip, '-', 'cleaning out ' + path)
-                            os.remove(path)
-                        else:
-                            cid = path[len(queuedir)+1:]
-                            msg = queueorstamp(ip, 'Requeue', cid, conf)
-                            logmsg(ip, '-', 'Requeued ' + cid + ': ' + msg)
-        else:
-            if servicerunning:
-                # this was an unclean shutdown, shouldn't happen
-                servicerunning = False
-                logmsg(ip, '-', 'NOTE: unclean shutdown detected')
-    else:
-        conflock.release()
+    if servicestatustime == 0:
+        # first request in this process, don't wait for the watcher
+        checkservice()
+
+    if pathinfo == '/metrics':
+        body = formatmetrics(metricgauges(snapshot))
+        if publisherd:
+            # the queue, publish and cleanup metrics are in the daemon
+            try:
+                with open(publishermetricsfile, 'r') as input:
+                    body += input.read()
+            except (IOError, OSError):
+                pass
+        return good_request(start_response, body)
 
     if not servicerunning:
         return bad_request(start_response, ip, '-', 'Service not running')
 
-    if startup:
-        return good_request(start_response, 'OK\n')
-
     if pathinfo == '/config':
         logmsg(ip, '-', 'Returning config')
         body = 'repos:'
@@ -560,15 +2852,9 @@ def dispatch(environ, start_response):
             logmsg(ip, '-', 'Unrecognized authorization scheme ' + scheme)
             return error_request(start_response, '403 Access denied', 'Unrecognized authorization scheme')
         try:
-            audience = ["https://wlcg.cern.ch/jwt/v1/any"]
-            if len(audiences) == 0:
-                audience.append("https://"+socket.gethostname())
-            else:
-                for a in audiences:
-                    audience.append(a)
-            token = scitokens.SciToken.deserialize(tokenstr.strip(), audience=audience)
+            token = verifytoken(tokenstr.strip())
             issuer = token['iss']
-            if issuer not in issuers:
+            if issuer not in snapshot.issuers:
                 logmsg(ip, '-', 'Token issuer ' + issuer + ' not in the list of trusted issuers')
                 return error_request(start_response, '403 Access denied', 'Untrusted token issuer')
             scopes = token['scope'].split(' ')
@@ -576,6 +2862,7 @@ def dispatch(environ, start_response):
                 logmsg(ip, '-', 'compute.create scope missing from token')
                 return error_request(start_response, '403 Access denied', 'compute.create scope missing from token')
             cn = token['sub']
+            inccounter('auth_total', (('method', 'token'),))
         except Exception as e:
             logmsg(ip, '-', 'error decoding token: ' + str(e))
             return error_request(start_response, '403 Access denied', 'Error decoding token: ' + str(e))
@@ -584,6 +2871,7 @@ def dispatch(environ, start_response):
             logmsg(ip, '-', 'No token or client cert, access denied')
             return error_request(start_response, '403 Access denied', 'Token or client cert required')
         cn = 'localhost'
+        inccounter('auth_total', (('method', 'localhost'),))
     else:
         dn = environ['SSL_CLIENT_S_DN']
 
@@ -614,90 +2902,354 @@ def dispatch(environ, start_response):
         endidx = cn.find('/')
         if endidx >= 0:
             cn = cn[0:endidx]
+        inccounter('auth_total', (('method', 'cert'),))
 
     cid = ''
     if 'cid' in parameters:
-        cid = os.path.normpath(parameters['cid'][0])
-        if cid[0] == '.':
-            return bad_request(start_response, ip, cn, 'cid may not start with "."')
-        if ("'" in cid) or ('\\' in cid):
-            # these are special to bash inside of single quotes
-            return bad_request(start_response, ip, cn, 'disallowed character in cid')
-        if cid.count('/') > 1:
-            # without this restriction it is challenging for cleanup
-            return bad_request(start_response, ip, cn, 'at most one slash allowed in cid')
+        cid, reason = checkcid(parameters['cid'][0])
+        if reason != '':
+            return bad_request(start_response, ip, cn, reason)
 
     if pathinfo == '/exists':
         if cid == '':
             return bad_request(start_response, ip, cn, 'exists with no cid')
-        inrepo = cidinrepo(cid, conf)
-        if inrepo is not None:
-            logmsg(ip, cn, 'present in ' + inrepo + ': ' + cid)
-            return good_request(start_response,
-                'PRESENT:' + repocidpath(inrepo, cid) + '\n')
-        logmsg(ip, cn, cid + ' missing')
-        return good_request(start_response, 'MISSING\n')
+        return good_request(start_response,
+            lookupcid(ip, cn, cid, conf, False))
 
     if pathinfo == '/update':
         if cid == '':
             return bad_request(start_response, ip, cn, 'update with no cid')
-        inrepo = cidinrepo(cid, conf)
-        if inrepo is not None:
-            stamp(ip, cn, cid, conf, ' in ' + inrepo + ', updating')
-            return good_request(start_response,
-                'PRESENT:' + repocidpath(inrepo, cid) + '\n')
-        logmsg(ip, cn, cid + ' missing, skipping update')
-        return good_request(start_response, 'MISSING\n')
+        return good_request(start_response,
+            lookupcid(ip, cn, cid, conf, True))
+
+    if pathinfo == '/wait':
+        if cid == '':
+            return bad_request(start_response, ip, cn, 'wait with no cid')
+        timeout = 60
+        if 'timeout' in parameters:
+            try:
+                timeout = int(parameters['timeout'][0])
+            except ValueError:
+                return bad_request(start_response, ip, cn, 'bad timeout')
+        timeout = max(0, min(timeout, maxwaittimeout))
+        if 'cvmfs_user_pub.asyncwait' in environ:
+            # the asynchronous front end waits without using a thread
+            return environ['cvmfs_user_pub.asyncwait'](cid, conf, timeout)
+        done = threading.Event()
+        result = []
+        def waiter(body):
+            result.append(body)
+            done.set()
+        body = startwait(cid, conf, waiter)
+        if body is None:
+            if startblockingwait():
+                logmsg(ip, cn, 'waiting up to ' + str(timeout) + \
+                        ' seconds for ' + cid)
+                try:
+                    done.wait(timeout)
+                finally:
+                    endblockingwait()
+            if not done.is_set():
+                removewaiter(cid, waiter)
+            if len(result) > 0:
+                body = result[0]
+            else:
+                body = 'PUBLISHING\n'
+        logmsg(ip, cn, 'wait for ' + cid + ': ' + body.strip())
+        return good_request(start_response, body)
+
+    if pathinfo == '/bulkexists' or pathinfo == '/bulkupdate':
+        length = int(environ.get('CONTENT_LENGTH','0'))
+        if length > maxbulkbytes:
+            return bad_request(start_response, ip, cn, 'too many cids')
+        try:
+            data = environ['wsgi.input'].read(length).decode('utf-8')
+        except Exception as e:
+            logmsg(ip, cn, 'error getting cid list: ' + str(e))
+            return bad_request(start_response, ip, cn, 'error reading cid list')
+        cids = []
+        for line in data.split('\n'):
+            line = line.strip()
+            if line == '':
+                continue
+            cid, reason = checkcid(line)
+            if reason != '':
+                return bad_request(start_response, ip, cn, reason + ': ' + line)
+            cids.append(cid)
+        if len(cids) == 0:
+            return bad_request(start_response, ip, cn, pathinfo[1:] + ' with no cids')
+        update = (pathinfo == '/bulkupdate')
+        body = ''
+        for cid in cids:
+            body += lookupcid(ip, cn, cid, conf, update)
+        return good_request(start_response, body)
 
     if pathinfo == '/publish':
         if cid == '':
             return bad_request(start_response, ip, cn, 'publish with no cid')
         contentlength = environ.get('CONTENT_LENGTH','0')
         length = int(contentlength)
+        format = ''
+        if 'format' in parameters:
+            format = parameters['format'][0]
+            if format not in tarformats:
+                return bad_request(start_response, ip, cn,
+                        'format must be one of ' + ', '.join(tarformats))
         input = environ['wsgi.input']
+        # Return early without reading the data if possible.  mod_wsgi
+        #  only sends "100 Continue" when the data is first read.
+        body = skipupload(ip, cn, cid, conf)
+        if body is not None:
+            return good_request(start_response, body)
+        # check limits before reading any of the data
+        reason, retryafter = reserveupload(cn, length)
+        if reason != '':
+            return busy_request(start_response, ip, cn, reason, retryafter)
         publock.acquire()
         if cid in pubcids:
+            # lost a race with another publish of the same cid
             publock.release()
+            doneuploading(cn)
             logmsg(ip, cn, cid + ' already publishing, skipping')
+            return good_request(start_response, 'OK\n')
+        pubcids[cid] = [cn, length]
+        publock.release()
+        streamrepo = None
+        if streamuploads and not validateuploads and not verifycidhash:
+            # streamed tarballs are extracted before they could be checked
+            streamrepo = claimidlerepo(cid)
+        if not os.path.exists(queuedir):
+            os.mkdir(queuedir)
+        ciddir = os.path.join(queuedir,os.path.dirname(cid))
+        cidpath = os.path.join(queuedir,cid)
+        tmppath = uploadtmppath(cidpath)
+        hasher = None
+        if dedupuploads or verifycidhash:
+            hasher = hashlib.sha256()
+        validator = None
+        if validateuploads:
+            validator = TarValidator(format)
+        uploadstart = time.time()
+        starttrace(cid)
+        try:
+            if not os.path.exists(ciddir):
+                os.mkdir(ciddir)
+            if streamrepo is not None:
+                try:
+                    published = streamupload(ip, cn, cid, streamrepo,
+                                input, length, tmppath, hasher,
+                                format)
+                finally:
+                    repolocks[streamrepo].release()
+                if published:
+                    logmsg(ip, cn, 'streamed ' + contentlength + \
+                            ' bytes into ' + streamrepo)
+                    countupload(int(contentlength), time.time() - uploadstart)
+                    tracespan(cid, 'upload', uploadstart, time.time())
+                    if dedupuploads:
+                        recordhash(hasher.hexdigest(), cid, False)
+                    doneuploading(cn)
+                    donepublishing(cid)
+                    return good_request(start_response, 'OK\n')
+            else:
+                with open(tmppath, 'wb') as output:
+                    while length > 0:
+                        bufsize = 16384
+                        if bufsize > length:
+                            bufsize = length
+                        buf = input.read(bufsize)
+                        output.write(buf)
+                        if hasher is not None:
+                            hasher.update(buf)
+                        if validator is not None:
+                            validator.update(buf)
+                            if validator.error != '':
+                                break
+                        length -= len(buf)
+            if validator is not None:
+                reason = checkvalidated(ip, cn, cid, validator, tmppath)
+                if reason != '':
+                    return bad_request(start_response, ip, cn,
+                                'invalid tarball: ' + reason)
+            os.rename(tmppath, cidpath)
+            logmsg(ip, cn, 'wrote ' + contentlength + ' bytes to ' + cidpath)
+            countupload(int(contentlength), time.time() - uploadstart)
+            tracespan(cid, 'upload', uploadstart, time.time())
+            doneuploading(cn)
+        except Exception as e:
+            logmsg(ip, cn, 'error getting publish data: ' + str(e))
+            endtrace(cid)
+            doneuploading(cn)
+            donepublishing(cid)
+            try:
+                os.remove(tmppath)
+            except OSError:
+                pass
+            return bad_request(start_response, ip, cn, 'error getting publish data')
+        return queueupload(start_response, ip, cn, cid, conf, hasher)
+
+    if pathinfo == '/uploadinit':
+        if cid == '':
+            return bad_request(start_response, ip, cn, 'No cid given')
+        try:
+            size = int(parameters['size'][0])
+        except (KeyError, ValueError):
+            return bad_request(start_response, ip, cn, 'No valid size given')
+        if size <= 0:
+            return bad_request(start_response, ip, cn, 'size must be positive')
+        format = ''
+        if 'format' in parameters:
+            format = parameters['format'][0]
+            if format not in tarformats:
+                return bad_request(start_response, ip, cn,
+                        'format must be one of ' + ', '.join(tarformats))
+        body = skipupload(ip, cn, cid, conf)
+        if body is not None:
+            return good_request(start_response, body)
+        reason, retryafter = checksessionlimits(cn, size)
+        if reason != '':
+            return busy_request(start_response, ip, cn, reason, retryafter)
+        try:
+            session = createsession(cid, cn, size, format)
+        except Exception as e:
+            logmsg(ip, cn, 'error creating upload session: ' + str(e))
+            return bad_request(start_response, ip, cn,
+                                'error creating upload session')
+        logmsg(ip, cn, 'started upload session ' + session + ' for ' + \
+                str(size) + ' bytes of ' + cid)
+        inccounter('upload_sessions_total', (('result', 'started'),))
+        return good_request(start_response, 'SESSION:' + session + '\n')
+
+    if pathinfo == '/uploadchunk':
+        info, path, reason = opensession(parameters, cn)
+        if reason != '':
+            return bad_request(start_response, ip, cn, reason)
+        try:
+            offset = int(parameters['offset'][0])
+        except (KeyError, ValueError):
+            return bad_request(start_response, ip, cn, 'No valid offset given')
+        length = int(environ.get('CONTENT_LENGTH','0'))
+        if offset < 0 or length <= 0 or offset + length > info['size']:
+            return bad_request(start_response, ip, cn,
+                                'chunk is outside of the upload')
+        input = environ['wsgi.input']
+        end = offset + length
+        try:
+            fd = os.open(os.path.join(path, 'data'), os.O_WRONLY)
             try:
-                # read the data and throw it away
+                os.lseek(fd, offset, os.SEEK_SET)
                 while length > 0:
                     bufsize = 16384
                     if bufsize > length:
                         bufsize = length
                     buf = input.read(bufsize)
+                    if len(buf) == 0:
+                        raise IOError('end of data after ' + \
+                            str(end - offset - length) + ' bytes')
+                    os.write(fd, buf)
                     length -= len(buf)
-            except Exception as e:
-                logmsg(ip, cn, 'error getting publish data: ' + str(e))
-                return bad_request(start_response, ip, cn, 'error reading publish data')
+            finally:
+                os.close(fd)
+            addrange(path, offset, end)
+        except Exception as e:
+            logmsg(ip, cn, 'error getting chunk data: ' + str(e))
+            return bad_request(start_response, ip, cn, 'error getting chunk data')
+        inccounter('upload_chunk_bytes_total', (), end - offset)
+        return good_request(start_response, 'OK\n')
+
+    if pathinfo == '/uploadstatus':
+        info, path, reason = opensession(parameters, cn)
+        if reason != '':
+            return bad_request(start_response, ip, cn, reason)
+        return good_request(start_response, 'SIZE:' + str(info['size']) + \
+                '\nRECEIVED:' + formatranges(receivedranges(path)) + '\n')
+
+    if pathinfo == '/uploadcommit':
+        info, path, reason = opensession(parameters, cn)
+        if reason != '':
+            return bad_request(start_response, ip, cn, reason)
+        cid = info['cid']
+        size = info['size']
+        ranges = receivedranges(path)
+        if ranges != [[0, size]]:
+            return bad_request(start_response, ip, cn,
+                'upload incomplete, received ' + formatranges(ranges))
+        body = skipupload(ip, cn, cid, conf)
+        if body is not None:
+            removesession(path)
+            return good_request(start_response, body)
+        # the session is kept if over the limits so the commit can be retried
+        reason, retryafter = reserveupload(cn, size)
+        if reason != '':
+            return busy_request(start_response, ip, cn, reason, retryafter)
+        publock.acquire()
+        if cid in pubcids:
+            publock.release()
+            doneuploading(cn)
+            removesession(path)
+            logmsg(ip, cn, cid + ' already publishing, skipping')
             return good_request(start_response, 'OK\n')
-        pubcids[cid] = 1
+        pubcids[cid] = [cn, size]
         publock.release()
         if not os.path.exists(queuedir):
             os.mkdir(queuedir)
         ciddir = os.path.join(queuedir,os.path.dirname(cid))
         cidpath = os.path.join(queuedir,cid)
+        tmppath = uploadtmppath(cidpath)
         try:
             if not os.path.exists(ciddir):
                 os.mkdir(ciddir)
-            with open(cidpath + '.tmp', 'wb') as output:
-                while length > 0:
-                    bufsize = 16384
-                    if bufsize > length:
-                        bufsize = length
-                    buf = input.read(bufsize)
-                    output.write(buf)
-                    length -= len(buf)
-            os.rename(cidpath + '.tmp', cidpath)
-            logmsg(ip, cn, 'wrote ' + contentlength + ' bytes to ' + cidpath)
+            # whoever renames the data first does the commit
+            os.rename(os.path.join(path, 'data'), tmppath)
+            # not stale, although the last chunk may have come long ago
+            os.utime(tmppath, None)
+        except OSError as e:
+            logmsg(ip, cn, 'error committing upload session: ' + str(e))
+            doneuploading(cn)
+            donepublishing(cid)
+            return bad_request(start_response, ip, cn,
+                                'Unknown or expired upload session')
+        removesession(path)
+        starttrace(cid)
+        hasher = None
+        if dedupuploads or verifycidhash:
+            hasher = hashlib.sha256()
+        validator = None
+        if validateuploads:
+            validator = TarValidator(info['format'])
+        try:
+            if hasher is not None or validator is not None:
+                with open(tmppath, 'rb') as input:
+                    while True:
+                        buf = input.read(1048576)
+                        if len(buf) == 0:
+                            break
+                        if hasher is not None:
+                            hasher.update(buf)
+                        if validator is not None:
+                            validator.update(buf)
         except Exception as e:
-            logmsg(ip, cn, 'error getting publish data: ' + str(e))
-            try:
-                os.remove(cidpath + '.tmp')
-            except OSError:
-                pass
-            return bad_request(start_response, ip, cn, 'error getting publish data')
-        return good_request(start_response, queueorstamp(ip, cn, cid, conf))
+            logmsg(ip, cn, 'error reading committed data: ' + str(e))
+            endtrace(cid)
+            doneuploading(cn)
+            donepublishing(cid)
+            os.remove(tmppath)
+            return bad_request(start_response, ip, cn,
+                                'error reading committed data')
+        if validator is not None:
+            reason = checkvalidated(ip, cn, cid, validator, tmppath)
+            if reason != '':
+                inccounter('upload_sessions_total', (('result', 'rejected'),))
+                return bad_request(start_response, ip, cn,
+                                'invalid tarball: ' + reason)
+        os.rename(tmppath, cidpath)
+        logmsg(ip, cn, 'committed ' + str(size) + ' bytes of upload session to ' + cidpath)
+        now = time.time()
+        countupload(size, now - info['created'])
+        tracespan(cid, 'upload', info['created'], now)
+        doneuploading(cn)
+        inccounter('upload_sessions_total', (('result', 'committed'),))
+        return queueupload(start_response, ip, cn, cid, conf, hasher)
 
     logmsg(ip, cn, 'Unrecognized api ' + pathinfo)
     return error_request(start_response, '404 Not found', 'Unrecognized api')
@@ -0,0 +1,180 @@
+# Asynchronous (ASGI) front end for the cvmfs-user-pub api
+# This serves the same /pubapi/<request> URLs as dispatch.wsgi, by
+#  running cvmfs_user_pub.dispatch() in thread pools, but the network
+#  I/O is done by the event loop so that any number of connections can
+#  share one process.  Request bodies are received only when dispatch()
+#  reads them, a chunk at a time, so early answers to publish still skip
+#  the upload.  Publishes and upload chunks run in their own pool of
+#  "asgiuploadthreads" threads (default 64) and all other requests in a
+#  separate pool of "asgilookupthreads" threads (default 8), so lookups
+#  are not held up behind slow uploads.  Requests to /wait hold no
+#  thread at all while they wait.
+#
+# It requires python3 and an ASGI server, for example
+#   uvicorn --uds /run/cvmfs-user-pub/asgi.sock \
+#       --app-dir /usr/share/cvmfs-user-pub/pyweb cvmfs_user_pub_asgi:application
+#  run as the cvmfspub user in place of the WSGIDaemonProcess, with
+#  httpd still terminating SSL and proxying to it like this:
+#   RequestHeader set X-SSL-Client-S-DN "%{SSL_CLIENT_S_DN}s"
+#   ProxyPass /pubapi/ unix:/run/cvmfs-user-pub/asgi.sock|http://localhost/pubapi/
+# The client address and DN are taken from the X-Forwarded-For and
+#  X-SSL-Client-S-DN headers only when the connection comes from the
+#  local proxy.
+#
+# This source file is Copyright (c) 2019, FERMI NATIONAL ACCELERATOR
+#    LABORATORY.  All rights reserved.
+# For details of the Fermitools (BSD) license see COPYING.
+
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future, InvalidStateError
+
+import cvmfs_user_pub
+
+executorlock = threading.Lock()
+executors = {}
+
+def getexecutor(kind):
+    executorlock.acquire()
+    if len(executors) == 0:
+        snapshot = cvmfs_user_pub.confsnapshot
+        if snapshot is None:
+            snapshot = cvmfs_user_pub.reloadconf()
+        conf = snapshot.conf
+        lookupthreads = 8
+        if 'asgilookupthreads' in conf:
+            lookupthreads = int(conf['asgilookupthreads'][0])
+        uploadthreads = 64
+        if 'asgiuploadthreads' in conf:
+            uploadthreads = int(conf['asgiuploadthreads'][0])
+        executors['lookup'] = ThreadPoolExecutor(lookupthreads,
+                                        thread_name_prefix='Lookup')
+        executors['upload'] = ThreadPoolExecutor(uploadthreads,
+                                        thread_name_prefix='Upload')
+    executor = executors[kind]
+    executorlock.release()
+    return executor
+
+# File-like wsgi.input that gets the request body from the event loop
+#  as it is read by dispatch(), which runs in an executor thread
+class BodyReader(object):
+    def __init__(self, loop, receive):
+        self.loop = loop
+        self.receive = receive
+        self.buf = b''
+        self.more = True
+
+    async def nextchunk(self):
+        message = await self.receive()
+        if message['type'] == 'http.disconnect':
+            raise IOError('client disconnected')
+        return message.get('body', b''), message.get('more_body', False)
+
+    def read(self, size=-1):
+        chunks = [self.buf]
+        buffered = len(self.buf)
+        while self.more and (size < 0 or buffered < size):
+            future = asyncio.run_coroutine_threadsafe(self.nextchunk(),
+                                                        self.loop)
+            chunk, self.more = future.result()
+            chunks.append(chunk)
+            buffered += len(chunk)
+        data = b''.join(chunks)
+        if size < 0:
+            size = len(data)
+        self.buf = data[size:]
+        return data[0:size]
+
+# Returned by dispatch() for a /wait, for application() to wait for the
+#  response in the event loop
+class PendingWait(object):
+    def __init__(self, cid, timeout):
+        self.cid = cid
+        self.timeout = timeout
+        self.future = Future()
+
+    def waiter(self, body):
+        try:
+            self.future.set_result(body)
+        except InvalidStateError:
+            # already timed out
+            pass
+
+def asyncwait(cid, conf, timeout):
+    pending = PendingWait(cid, timeout)
+    body = cvmfs_user_pub.startwait(cid, conf, pending.waiter)
+    if body is not None:
+        pending.waiter(body)
+    return pending
+
+def makeenviron(scope, input):
+    headers = {}
+    for name, value in scope['headers']:
+        headers[name.decode('latin-1').lower()] = value.decode('latin-1')
+    ip = '127.0.0.1'
+    if scope.get('client') is not None:
+        ip = scope['client'][0]
+    proxied = (ip == '127.0.0.1')
+    if proxied and 'x-forwarded-for' in headers:
+        # the last address is the one added by the local proxy
+        ip = headers['x-forwarded-for'].split(',')[-1].strip()
+    path = scope['path']
+    if path.startswith('/pubapi/'):
+        path = path[len('/pubapi'):]
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'REMOTE_ADDR': ip,
+        'PATH_INFO': path,
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'wsgi.input': input,
+        'cvmfs_user_pub.asyncwait': asyncwait,
+    }
+    if 'content-length' in headers:
+        environ['CONTENT_LENGTH'] = headers['content-length']
+    if 'authorization' in headers:
+        environ['HTTP_AUTHORIZATION'] = headers['authorization']
+    if proxied and headers.get('x-ssl-client-s-dn', '') != '':
+        environ['SSL_CLIENT_S_DN'] = headers['x-ssl-client-s-dn']
+    return environ
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+    if scope['type'] != 'http':
+        return
+
+    loop = asyncio.get_running_loop()
+    environ = makeenviron(scope, BodyReader(loop, receive))
+    kind = 'lookup'
+    if environ['PATH_INFO'] in ('/publish', '/uploadchunk', '/uploadcommit'):
+        kind = 'upload'
+
+    response = []
+    def start_response(status, headers):
+        response.append((status, headers))
+
+    body = await loop.run_in_executor(getexecutor(kind),
+                        cvmfs_user_pub.dispatch, environ, start_response)
+    if isinstance(body, PendingWait):
+        try:
+            result = await asyncio.wait_for(
+                    asyncio.wrap_future(body.future), body.timeout)
+        except asyncio.TimeoutError:
+            cvmfs_user_pub.removewaiter(body.cid, body.waiter)
+            result = 'PUBLISHING\n'
+        cvmfs_user_pub.logmsg(environ['REMOTE_ADDR'], '-', 'wait for ' + \
+                body.cid + ': ' + result.strip())
+        body = cvmfs_user_pub.good_request(start_response, result)
+    status, headers = response[0]
+    await send({'type': 'http.response.start',
+                'status': int(status.split()[0]),
+                'headers': [(name.lower().encode('latin-1'),
+                                value.encode('latin-1'))
+                                    for name, value in headers]})
+    await send({'type': 'http.response.body', 'body': b''.join(body)})
@@ -14,6 +14,9 @@ Requires: httpd
 %if %{rhel} > 7
 Requires: python3-mod_wsgi
 Requires: python3-scitokens
+# parallel and additional decompressors for published tarballs
+Recommends: pigz
+Recommends: zstd
 %else
 Requires: mod_wsgi
 Requires: python2-scitokens
@@ -44,17 +47,28 @@ install -p -m 444 etc/%{name}.default $RPM_BUILD_ROOT/etc/cvmfs/default.d/99-%{n
 install -p -m 444 misc/%{name}.conf $RPM_BUILD_ROOT/etc/httpd/conf.d/10-%{name}.conf
 mkdir -p $RPM_BUILD_ROOT/usr/lib/systemd/system/httpd.service.d
 install -p -m 444 misc/%{name}.service $RPM_BUILD_ROOT/usr/lib/systemd/system/%{name}.service
+install -p -m 444 misc/%{name}d.service $RPM_BUILD_ROOT/usr/lib/systemd/system/%{name}d.service
 install -p -m 444 misc/systemd-httpd.conf $RPM_BUILD_ROOT/usr/lib/systemd/system/httpd.service.d/%{name}.conf
 mkdir -p $RPM_BUILD_ROOT/var/www/wsgi-scripts/%{name}
 install -p -m 555 misc/dispatch.wsgi $RPM_BUILD_ROOT/var/www/wsgi-scripts/%{name}
 mkdir -p $RPM_BUILD_ROOT/usr/share/%{name}/pyweb
 install -p -m 444 pyweb/* $RPM_BUILD_ROOT/usr/share/%{name}/pyweb
+%if %{rhel} <= 7
+# the asynchronous front end needs python3
+rm -f $RPM_BUILD_ROOT/usr/share/%{name}/pyweb/cvmfs_user_pub_asgi.py
+%endif
 mkdir -p $RPM_BUILD_ROOT/usr/libexec/%{name}
+mkdir -p $RPM_BUILD_ROOT/var/lib/%{name}
 install -p -m 555 libexec/gcsnapshots $RPM_BUILD_ROOT/usr/libexec/%{name}/gcsnapshots
 install -p -m 555 libexec/initrepos $RPM_BUILD_ROOT/usr/libexec/%{name}/initrepos
 install -p -m 555 libexec/ping $RPM_BUILD_ROOT/usr/libexec/%{name}/ping
 install -p -m 555 libexec/publish $RPM_BUILD_ROOT/usr/libexec/%{name}/publish
 install -p -m 555 libexec/snapshots $RPM_BUILD_ROOT/usr/libexec/%{name}/snapshots
+install -p -m 555 libexec/tracestats $RPM_BUILD_ROOT/usr/libexec/%{name}/tracestats
+install -p -m 555 libexec/publisherd $RPM_BUILD_ROOT/usr/libexec/%{name}/publisherd
+%if %{rhel} <= 7
+sed -i '1s/python3/python2/' $RPM_BUILD_ROOT/usr/libexec/%{name}/publisherd
+%endif
 
 %post
 if ! getent group cvmfspub >/dev/null 2>&1 ; then
@@ -74,6 +88,7 @@ if [ ! -d /home/cvmfspub ]; then
     chown cvmfspub:cvmfspub /home/cvmfspub
     chmod 755 /home/cvmfspub
 fi
+chown cvmfspub:cvmfspub /var/lib/%{name}
 
 systemctl daemon-reload
 
@@ -114,7 +129,9 @@ done
 /var/www/wsgi-scripts/%{name}
 /usr/share/%{name}
 /usr/libexec/%{name}
+%dir /var/lib/%{name}
 /usr/lib/systemd/system/%{name}.service
+/usr/lib/systemd/system/%{name}d.service
 /usr/lib/systemd/system/httpd.service.d
 
 
@@ -0,0 +1,102 @@
+# Tests of the journal that cvmfs_user_pub web service processes share
+#  with the publisher daemon.
+# Run with
+#   python -m unittest discover tests
+#  from the top of the source tree.
+#
+# This source file is Copyright (c) 2019, FERMI NATIONAL ACCELERATOR
+#    LABORATORY.  All rights reserved.
+# For details of the Fermitools (BSD) license see COPYING.
+
+import os, sys, json, shutil, tempfile, unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'pyweb'))
+
+import cvmfs_user_pub
+
+def queue(cid, **fields):
+    record = {'op': 'queue', 'cid': cid, 'cn': 'user'}
+    record.update(fields)
+    return record
+
+def done(cid):
+    return {'op': 'done', 'cid': cid}
+
+def stamp(cid):
+    return {'op': 'stamp', 'cid': cid, 'cn': 'user'}
+
+def stampdone(cid):
+    return {'op': 'stampdone', 'cid': cid}
+
+class CompactJournalTest(unittest.TestCase):
+    def setUp(self):
+        self.savedjournalfile = cvmfs_user_pub.journalfile
+        self.tmpdir = tempfile.mkdtemp()
+        cvmfs_user_pub.journalfile = os.path.join(self.tmpdir, 'journal')
+
+    def tearDown(self):
+        cvmfs_user_pub.journalfile = self.savedjournalfile
+        shutil.rmtree(self.tmpdir)
+
+    def readfile(self):
+        with open(cvmfs_user_pub.journalfile, 'rb') as input:
+            return input.read()
+
+    def compact(self):
+        pending, size = cvmfs_user_pub.compactjournal()
+        data = self.readfile()
+        self.assertEqual(size, len(data))
+        self.assertEqual(cvmfs_user_pub.parsejournal(data), pending)
+        return pending
+
+    def test_missing(self):
+        self.assertEqual(self.compact(), [])
+        self.assertEqual(self.readfile(), b'')
+
+    def test_done_removed(self):
+        cvmfs_user_pub.journalappend([queue('a'), queue('b'), done('a'),
+                        stamp('c'), stamp('d'), stampdone('d')])
+        self.assertEqual(self.compact(), [queue('b'), stamp('c')])
+
+    def test_order_kept(self):
+        cvmfs_user_pub.journalappend([stamp('c'), queue('b'), queue('a')])
+        self.assertEqual(self.compact(), [stamp('c'), queue('b'), queue('a')])
+
+    def test_fields_kept(self):
+        record = queue('a', files=3, bytes=300, trace='0123456789abcdef')
+        cvmfs_user_pub.journalappend([record])
+        self.assertEqual(self.compact(), [record])
+
+    def test_repeated(self):
+        cvmfs_user_pub.journalappend([queue('a'), queue('b'), queue('a'),
+                        stamp('c'), stamp('c')])
+        self.assertEqual(self.compact(), [queue('a'), queue('b'), stamp('c')])
+
+    def test_requeued_after_done(self):
+        cvmfs_user_pub.journalappend([queue('a'), queue('b'), done('a'),
+                        queue('a')])
+        self.assertEqual(self.compact(), [queue('b'), queue('a')])
+
+    def test_partial_line(self):
+        cvmfs_user_pub.journalappend([queue('a')])
+        with open(cvmfs_user_pub.journalfile, 'ab') as output:
+            output.write(json.dumps(queue('b')).encode('utf-8')[0:10])
+        self.assertEqual(self.compact(), [queue('a')])
+
+    def test_bad_line(self):
+        with open(cvmfs_user_pub.journalfile, 'wb') as output:
+            output.write(b'not json\n')
+        cvmfs_user_pub.journalappend([queue('a')])
+        self.assertEqual(self.compact(), [queue('a')])
+
+    def test_append_after_compact(self):
+        cvmfs_user_pub.journalappend([queue('a'), done('a'), queue('b')])
+        pending, offset = cvmfs_user_pub.compactjournal()
+        cvmfs_user_pub.journalappend([queue('c')])
+        records, newoffset = cvmfs_user_pub.readjournal(offset)
+        self.assertEqual(records, [queue('c')])
+        self.assertEqual(newoffset, len(self.readfile()))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+# Tests of how the publish queue in cvmfs_user_pub picks what to
+#  publish next.
+# Run with
+#   python -m unittest discover tests
+#  from the top of the source tree.
+#
+# This source file is Copyright (c) 2019, FERMI NATIONAL ACCELERATOR
+#    LABORATORY.  All rights reserved.
+# For details of the Fermitools (BSD) license see COPYING.
+
+import os, sys, time, unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'pyweb'))
+
+import cvmfs_user_pub
+
+MB = 1024 * 1024
+
+class PubSchedulerTest(unittest.TestCase):
+    settings = ['schedpolicy', 'smalljobmb', 'maxqueuewait', 'fairshare',
+                'placement', 'timestampwait', 'timestampmaxcids', 'queuedir']
+
+    def setUp(self):
+        self.saved = dict([(name, getattr(cvmfs_user_pub, name))
+                                for name in self.settings])
+        self.savedtscids = dict(cvmfs_user_pub.tscids)
+        cvmfs_user_pub.queuedir = '/nonexistent/cvmfs-user-pub'
+        self.sched = cvmfs_user_pub.PubScheduler()
+
+    def tearDown(self):
+        for name in self.settings:
+            setattr(cvmfs_user_pub, name, self.saved[name])
+        cvmfs_user_pub.tscids.clear()
+        cvmfs_user_pub.tscids.update(self.savedtscids)
+
+    # add an entry queued age seconds ago, returning its index
+    def add(self, cid, size=0, cn='user', option='queued', owner=None,
+                age=0):
+        self.sched.entries.append([time.time() - age, size,
+                                    [cid, cn, {}, option], owner])
+        return len(self.sched.entries) - 1
+
+    def chosen(self, repo='repo1'):
+        idx = self.sched.choose(repo)
+        if idx is None:
+            return None
+        return self.sched.entries[idx][2][0]
+
+    def test_fifo(self):
+        cvmfs_user_pub.schedpolicy = 'fifo'
+        self.add('big', 500 * MB)
+        self.add('small', 1 * MB)
+        self.assertEqual(self.chosen(), 'big')
+
+    def test_smallfirst(self):
+        cvmfs_user_pub.schedpolicy = 'smallfirst'
+        cvmfs_user_pub.smalljobmb = 100
+        self.add('big', 500 * MB)
+        self.add('small', 1 * MB)
+        self.assertEqual(self.chosen(), 'small')
+
+    def test_maxqueuewait(self):
+        cvmfs_user_pub.schedpolicy = 'smallfirst'
+        cvmfs_user_pub.smalljobmb = 100
+        cvmfs_user_pub.maxqueuewait = 600
+        self.add('old', 500 * MB, age=700)
+        self.add('small', 1 * MB)
+        self.assertEqual(self.chosen(), 'old')
+
+    def test_big_left_for_faster_repo(self):
+        cvmfs_user_pub.schedpolicy = 'smallfirst'
+        cvmfs_user_pub.smalljobmb = 100
+        cvmfs_user_pub.placement = 'any'
+        self.add('big', 500 * MB)
+        self.sched.recordlatency('repo1', 100)
+        self.sched.recordlatency('repo2', 10)
+        self.sched.waiting.add('repo2')
+        self.assertEqual(self.chosen('repo1'), None)
+        self.assertEqual(self.chosen('repo2'), 'big')
+        # nobody faster waiting
+        self.sched.waiting.clear()
+        self.assertEqual(self.chosen('repo1'), 'big')
+
+    def test_owner(self):
+        cvmfs_user_pub.schedpolicy = 'fifo'
+        self.add('mine', owner='repo2')
+        self.add('any')
+        self.assertEqual(self.chosen('repo1'), 'any')
+        self.assertEqual(self.chosen('repo2'), 'mine')
+
+    def test_timestamp_debounce(self):
+        cvmfs_user_pub.schedpolicy = 'fifo'
+        cvmfs_user_pub.timestampwait = 60
+        cvmfs_user_pub.timestampmaxcids = 2
+        cvmfs_user_pub.tscids.clear()
+        cvmfs_user_pub.tscids['ts1'] = [1, 'user', time.time()]
+        self.add('ts1', option='ts')
+        self.assertEqual(self.chosen(), None)
+        self.assertTrue(self.sched.tsdelay > 50)
+        # a tarball is not held up by the timestamps
+        self.add('tarball')
+        self.assertEqual(self.chosen(), 'tarball')
+        # enough timestamps are published without waiting
+        self.sched.entries.pop()
+        cvmfs_user_pub.tscids['ts2'] = [1, 'user', time.time()]
+        self.assertEqual(self.chosen(), 'ts1')
+        self.assertEqual(self.sched.tsdelay, 0)
+
+    def test_fairshare(self):
+        cvmfs_user_pub.schedpolicy = 'fifo'
+        cvmfs_user_pub.fairshare = True
+        cvmfs_user_pub.placement = 'any'
+        for cid, cn in [('a1', 'alice'), ('a2', 'alice'), ('a3', 'alice'),
+                        ('b1', 'bob')]:
+            self.sched.put([cid, cn, {}, 'queued'])
+        order = [self.sched.get(False)[0] for i in range(4)]
+        self.assertEqual(order, ['a1', 'b1', 'a2', 'a3'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+# Tests of the validation of uploaded tarballs in cvmfs_user_pub.
+# Run with
+#   python -m unittest discover tests
+#  from the top of the source tree.
+#
+# This source file is Copyright (c) 2019, FERMI NATIONAL ACCELERATOR
+#    LABORATORY.  All rights reserved.
+# For details of the Fermitools (BSD) license see COPYING.
+
+import os, sys, io, tarfile, zlib, bz2, unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'pyweb'))
+
+import cvmfs_user_pub
+
+def maketar(nfiles=3, size=100000):
+    buf = io.BytesIO()
+    tar = tarfile.open(fileobj=buf, mode='w', format=tarfile.GNU_FORMAT)
+    for i in range(nfiles):
+        info = tarfile.TarInfo('dir/file' + str(i))
+        info.size = size
+        tar.addfile(info, io.BytesIO(os.urandom(size)))
+    tar.close()
+    return buf.getvalue()
+
+def gzipstream(data):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+# Split data into pieces and compress each as a separate stream, the
+#  way pigz and pbzip2 do
+def multistream(data, compress, piecesize=50000):
+    return b''.join([compress(data[i:i+piecesize])
+                        for i in range(0, len(data), piecesize)])
+
+def validate(data, chunksize=4096, format=''):
+    validator = cvmfs_user_pub.TarValidator(format)
+    for i in range(0, len(data), chunksize):
+        validator.update(data[i:i+chunksize])
+    return validator.finish(), validator
+
+class TarValidatorTest(unittest.TestCase):
+    def test_plain(self):
+        reason, validator = validate(maketar())
+        self.assertEqual(reason, '')
+        self.assertEqual(validator.files, 3)
+        self.assertEqual(validator.size, 300000)
+
+    def test_truncated(self):
+        data = gzipstream(maketar())
+        reason, validator = validate(data[0:len(data)//2])
+        self.assertEqual(validator.kind, 'truncated')
+
+    def test_concatenated_gzip(self):
+        data = multistream(maketar(), gzipstream)
+        reason, validator = validate(data)
+        self.assertEqual(reason, '')
+        self.assertEqual(validator.format, 'gzip')
+        self.assertEqual(validator.files, 3)
+
+    def test_concatenated_bzip2(self):
+        data = multistream(maketar(), bz2.compress)
+        for chunksize in (1000, 50000, len(data)):
+            reason, validator = validate(data, chunksize)
+            self.assertEqual(reason, '')
+            self.assertEqual(validator.format, 'bzip2')
+            self.assertEqual(validator.size, 300000)
+
+    def test_unsafe_path(self):
+        buf = io.BytesIO()
+        tar = tarfile.open(fileobj=buf, mode='w')
+        tar.addfile(tarfile.TarInfo('dir/../../escape'))
+        tar.close()
+        reason, validator = validate(buf.getvalue())
+        self.assertEqual(validator.kind, 'path')
+
+if __name__ == '__main__':
+    unittest.main()
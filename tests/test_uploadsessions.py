@@ -0,0 +1,107 @@
+# Tests of the upload sessions in cvmfs_user_pub that let big tarballs
+#  be sent in chunks.
+# Run with
+#   python -m unittest discover tests
+#  from the top of the source tree.
+#
+# This source file is Copyright (c) 2019, FERMI NATIONAL ACCELERATOR
+#    LABORATORY.  All rights reserved.
+# For details of the Fermitools (BSD) license see COPYING.
+
+import os, sys, time, shutil, tempfile, unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'pyweb'))
+
+import cvmfs_user_pub
+
+class UploadSessionTest(unittest.TestCase):
+    settings = ['sessiondir', 'sessionexpirehours']
+
+    def setUp(self):
+        self.saved = dict([(name, getattr(cvmfs_user_pub, name))
+                                for name in self.settings])
+        self.tmpdir = tempfile.mkdtemp()
+        cvmfs_user_pub.sessiondir = os.path.join(self.tmpdir, 'sessions')
+
+    def tearDown(self):
+        for name in self.settings:
+            setattr(cvmfs_user_pub, name, self.saved[name])
+        shutil.rmtree(self.tmpdir)
+
+    def newsession(self, cn='user', size=1000):
+        session = cvmfs_user_pub.createsession('cid', cn, size, 'tgz')
+        return session, os.path.join(cvmfs_user_pub.sessiondir, session)
+
+    def ranges(self, added):
+        session, path = self.newsession()
+        for offset, end in added:
+            cvmfs_user_pub.addrange(path, offset, end)
+        return cvmfs_user_pub.receivedranges(path)
+
+    def test_none(self):
+        self.assertEqual(self.ranges([]), [])
+
+    def test_separate(self):
+        self.assertEqual(self.ranges([[0, 100], [200, 300]]),
+                            [[0, 100], [200, 300]])
+
+    def test_adjacent(self):
+        self.assertEqual(self.ranges([[0, 100], [100, 200], [200, 300]]),
+                            [[0, 300]])
+
+    def test_out_of_order(self):
+        self.assertEqual(self.ranges([[200, 300], [0, 100], [100, 200]]),
+                            [[0, 300]])
+
+    def test_overlapping(self):
+        self.assertEqual(self.ranges([[0, 150], [100, 250], [400, 500]]),
+                            [[0, 250], [400, 500]])
+
+    def test_contained(self):
+        self.assertEqual(self.ranges([[0, 300], [100, 200]]), [[0, 300]])
+
+    def test_repeated(self):
+        self.assertEqual(self.ranges([[0, 100], [0, 100]]), [[0, 100]])
+
+    def test_partial_line(self):
+        session, path = self.newsession()
+        cvmfs_user_pub.addrange(path, 0, 100)
+        with open(os.path.join(path, 'ranges'), 'a') as output:
+            output.write('100')
+        self.assertEqual(cvmfs_user_pub.receivedranges(path), [[0, 100]])
+
+    def test_formatranges(self):
+        self.assertEqual(cvmfs_user_pub.formatranges([]), '')
+        self.assertEqual(cvmfs_user_pub.formatranges([[0, 100], [200, 300]]),
+                            '0-100,200-300')
+
+    def test_opensession(self):
+        session, path = self.newsession(size=1000)
+        info, openedpath, reason = cvmfs_user_pub.opensession(
+                                    {'session': [session]}, 'user')
+        self.assertEqual(reason, '')
+        self.assertEqual(openedpath, path)
+        self.assertEqual(info['size'], 1000)
+        self.assertEqual(os.path.getsize(os.path.join(path, 'data')), 1000)
+        info, openedpath, reason = cvmfs_user_pub.opensession(
+                                    {'session': [session]}, 'other')
+        self.assertEqual(info, None)
+        self.assertEqual(reason, 'Upload session belongs to another publisher')
+        info, openedpath, reason = cvmfs_user_pub.opensession(
+                                    {'session': ['../' + session]}, 'user')
+        self.assertEqual(reason, 'Malformed session')
+
+    def test_cleanupsessions(self):
+        cvmfs_user_pub.sessionexpirehours = 1
+        oldsession, oldpath = self.newsession()
+        newsession, newpath = self.newsession()
+        old = time.time() - 2 * 60 * 60
+        for name in os.listdir(oldpath):
+            os.utime(os.path.join(oldpath, name), (old, old))
+        os.utime(oldpath, (old, old))
+        cvmfs_user_pub.cleanupsessions()
+        self.assertEqual(os.listdir(cvmfs_user_pub.sessiondir), [newsession])
+
+if __name__ == '__main__':
+    unittest.main()